@@ -2,21 +2,36 @@ import numpy as np
 import xarray as xr
 
 
-def fire(y, src, inds=None):
-    da = xr.Dataset()
-    da['x'] = src.x
-    da['y'] = src.y
-    da['time'] = src.time
-    da['lat'] = (['y', 'x'], src['lat'])
-    da['lon'] = (['y', 'x'], src['lon'])
+def fire(y, src, inds=None, out=None, dtype='float64', fill_value=0):
+    """
+    Assemble flat fire predictions into a (time, y, x) dataset on the grid of src
+
+    With inds, y holds predictions for those flat (time, y, x) indices only and
+    cells outside them get fill_value. out is an optional preallocated
+    (time, y, x) buffer to write into; with inds only the indexed cells are
+    written, so a buffer can be reused across calls that share the same inds
+    without refilling it. Coordinates and lat/lon reference those of src
+    rather than being copied.
+    """
     shape = (len(src.time), len(src.y), len(src.x))
 
+    if out is None:
+        if inds is None:
+            out = np.empty(shape, dtype=dtype)
+        else:
+            out = np.full(shape, fill_value, dtype=dtype)
+    flat = out.reshape(-1)
+    if not np.shares_memory(flat, out):
+        raise ValueError('out must be a contiguous (time, y, x) array')
+
     if inds is None:
-        yfull = y.reshape(shape)
+        flat[:] = y
     else:
-        yfull = np.zeros(shape).flatten()
-        yfull[inds] = y
-        yfull = yfull.reshape(shape)
-    da['prediction'] = (['time', 'y', 'x'], yfull)
+        flat[inds] = y
+
+    da = xr.Dataset(coords={k: src[k].variable for k in ['x', 'y', 'time']})
+    da['lat'] = src['lat'].variable
+    da['lon'] = src['lon'].variable
+    da['prediction'] = xr.Variable(['time', 'y', 'x'], out)
 
     return da
@@ -1,4 +1,4 @@
 # flake8: noqa
-from .growth import growth
-from .hurdle import hurdle
+from .growth import growth, growth_grouped
+from .hurdle import BlockFold, hurdle, hurdle_folds, hurdle_grouped
 from .interp import interp
@@ -0,0 +1,44 @@
+import json
+
+import fsspec
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def write_artifact(path, kind, arrays, meta):
+    """
+    write a fitted model as one .npz file: numeric arrays plus a json metadata record
+
+    path can be a local path or any fsspec url. Arrays that are None are skipped.
+    """
+    from .. import __version__
+
+    meta = {'kind': kind, 'format_version': FORMAT_VERSION, 'package_version': __version__, **meta}
+    arrays = {k: np.asarray(v) for k, v in arrays.items() if v is not None}
+    with fsspec.open(str(path), 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta, default=_to_json)), **arrays)
+
+
+def read_artifact(path, kind):
+    """read back the arrays and metadata written by write_artifact, checking kind and format"""
+    with fsspec.open(str(path), 'rb') as f:
+        with np.load(f, allow_pickle=False) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+    meta = json.loads(str(arrays.pop('meta')))
+    if meta.get('kind') != kind:
+        raise ValueError(f"{path} holds a '{meta.get('kind')}' model, not '{kind}'")
+    if meta.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(
+            f"{path} uses model format {meta['format_version']}, "
+            f'newer than the supported {FORMAT_VERSION}'
+        )
+    return arrays, meta
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not json serializable')
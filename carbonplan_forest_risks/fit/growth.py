@@ -1,8 +1,15 @@
+import time
 import warnings
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from scipy.optimize import Bounds, minimize
-from scipy.stats import gamma, norm
+import pandas as pd
+import xarray as xr
+from scipy.optimize import Bounds, OptimizeResult, minimize
+from scipy.special import digamma, gammaln, polygamma, xlogy
+
+from .artifact import read_artifact, write_artifact
 
 
 def logistic(x, f, p):
@@ -14,16 +21,113 @@ def logistic(x, f, p):
     )
 
 
-def growth(x, y, f, noise='gamma', init=None):
-    def loglik(x, y, f, p):
-        a, b, c, w0, w1, scale = p
-        _mu = logistic(x, f, [a, b, c, w0, w1])
-        if noise == 'gamma':
-            return -np.sum(gamma.logpdf(y, np.maximum(_mu / scale, 1e-12), scale=scale))
-        if noise == 'normal':
-            return -np.sum(norm.logpdf(y, loc=_mu, scale=scale))
+def logistic_grad(x, f, p):
+    """logistic mean and its (5, n) gradient with respect to a, b, c, w0, w1"""
+    a, b, c, w0, w1 = p
+    amplitude = a + w0 * f[0] + w1 * f[1]
+    e = np.exp(-b * x)
+    d = 1 + c * e
+    g = 1 / d
+    shape = (g - 1 / (1 + c)) * ((c + 1) / c)
+    dshape_db = (c + 1) * x * e / d**2
+    dshape_dc = (1 - g) / c**2 - (c + 1) * e / (c * d**2)
+    grad = np.stack(
+        np.broadcast_arrays(
+            shape,
+            amplitude * dshape_db,
+            amplitude * dshape_dc,
+            f[0] * shape,
+            f[1] * shape,
+        )
+    )
+    return amplitude * shape, grad
+
+
+def negloglik(x, y, f, p, noise='gamma'):
+    """negative log-likelihood of the growth model and its gradient with respect to p"""
+    a, b, c, w0, w1, scale = p
+    mu, dmu = logistic_grad(x, f, [a, b, c, w0, w1])
+    if noise == 'gamma':
+        # same expression as scipy.stats.gamma.logpdf(y, k, scale=scale)
+        k = mu / scale
+        clipped = k < 1e-12
+        k = np.maximum(k, 1e-12)
+        z = y / scale
+        ll = np.where(y < 0, -np.inf, xlogy(k - 1, z) - z - gammaln(k) - np.log(scale))
+        dll_dk = np.where(clipped, 0, np.log(z) - digamma(k))
+        dll_dmu = dll_dk / scale
+        dll_dscale = -k / scale + y / scale**2 - dll_dk * mu / scale**2
+    if noise == 'normal':
+        resid = y - mu
+        ll = -0.5 * np.log(2 * np.pi) - np.log(scale) - resid**2 / (2 * scale**2)
+        dll_dmu = resid / scale**2
+        dll_dscale = -1 / scale + resid**2 / scale**3
+    grad = np.append(-(dmu @ dll_dmu), -np.sum(dll_dscale))
+    return -np.sum(ll), grad
+
+
+def negloglik_hess(x, y, f, p, noise='gamma'):
+    """(6, 6) Hessian of negloglik with respect to p"""
+    a, b, c, w0, w1, scale = p
+    mu, dmu = logistic_grad(x, f, [a, b, c, w0, w1])
+    amplitude = a + w0 * f[0] + w1 * f[1]
+    if noise == 'gamma':
+        k = mu / scale
+        clipped = k < 1e-12
+        k = np.maximum(k, 1e-12)
+        z = y / scale
+        dll_dk = np.where(clipped, 0, np.log(z) - digamma(k))
+        trigamma = np.where(clipped, 0, polygamma(1, k))
+        dll_dmu = dll_dk / scale
+        d2ll_dmu2 = -trigamma / scale**2
+        d2ll_dmu_dscale = np.where(clipped, 0, (k * trigamma - 1 - dll_dk) / scale**2)
+        d2ll_dscale2 = np.where(
+            clipped,
+            k / scale**2 - 2 * y / scale**3,
+            (3 * mu - 2 * y + 2 * mu * dll_dk) / scale**3 - k**2 * trigamma / scale**2,
+        )
+    if noise == 'normal':
+        resid = y - mu
+        dll_dmu = resid / scale**2
+        d2ll_dmu2 = np.full_like(resid, -1 / scale**2)
+        d2ll_dmu_dscale = -2 * resid / scale**3
+        d2ll_dscale2 = 1 / scale**2 - 3 * resid**2 / scale**4
+
+    # second derivatives of the logistic mean, which is amplitude (linear in a, w0, w1)
+    # times a shape in b and c, weighted by dll_dmu
+    e = np.exp(-b * x)
+    d = 1 + c * e
+    g = 1 / d
+    dshape_db = (c + 1) * x * e / d**2
+    dshape_dc = (1 - g) / c**2 - (c + 1) * e / (c * d**2)
+    d2shape_db2 = (c + 1) * x**2 * e * (c * e - 1) / d**3
+    d2shape_dbdc = x * e * (1 - c * e - 2 * e) / d**3
+    d2shape_dc2 = 2 * e / (c * d) ** 2 + 2 * (c + 1) * e**2 / (c * d**3) - 2 * (1 - g) / c**3
+    linear = {0: 1, 3: f[0], 4: f[1]}
+    d2mu = np.zeros((5, 5))
+    for i, di in linear.items():
+        d2mu[i, 1] = d2mu[1, i] = np.sum(dll_dmu * di * dshape_db)
+        d2mu[i, 2] = d2mu[2, i] = np.sum(dll_dmu * di * dshape_dc)
+    d2mu[1, 1] = np.sum(dll_dmu * amplitude * d2shape_db2)
+    d2mu[1, 2] = d2mu[2, 1] = np.sum(dll_dmu * amplitude * d2shape_dbdc)
+    d2mu[2, 2] = np.sum(dll_dmu * amplitude * d2shape_dc2)
+
+    hess = np.empty((6, 6))
+    hess[:5, :5] = -((dmu * d2ll_dmu2) @ dmu.T + d2mu)
+    hess[:5, 5] = hess[5, :5] = -(dmu @ d2ll_dmu_dscale)
+    hess[5, 5] = -np.sum(d2ll_dscale2)
+    return hess
 
-    fx = lambda p: loglik(x, y, f, p)
+
+def growth(x, y, f, noise='gamma', init=None, method='trust-constr'):
+    """
+    fit the logistic growth model by maximum likelihood
+
+    Uses the analytic gradient and, for method='trust-constr' (the default),
+    the analytic Hessian. Other bounded scipy methods such as 'L-BFGS-B' can be
+    passed but stop early on poorly scaled covariates.
+    """
+    fx = lambda p: negloglik(x, y, f, p, noise=noise)
 
     lb = np.ones((6,)) * 0.00001
     lb[2] = 1
@@ -33,11 +137,14 @@ def growth(x, y, f, noise='gamma', init=None):
     bounds = Bounds(lb, ub)
     if init is None:
         init = [np.nanmean(y), 0.1, 10, 0, 0, np.nanstd(y)]
-    options_trust = {'maxiter': 10000}
+    options = {'maxiter': 10000}
+    hess = (lambda p: negloglik_hess(x, y, f, p, noise=noise)) if method == 'trust-constr' else None
 
     with warnings.catch_warnings():
         warnings.filterwarnings('ignore', category=UserWarning)
-        result = minimize(fx, init, bounds=bounds, method='trust-constr', options=options_trust)
+        result = minimize(
+            fx, init, jac=True, hess=hess, bounds=bounds, method=method, options=options
+        )
 
     if result.success is False:
         print('optimization failed')
@@ -45,10 +152,127 @@ def growth(x, y, f, noise='gamma', init=None):
     return GrowthModel(result, noise, x, y, f)
 
 
+def _fit_growth_group(x, y, f, noise, method):
+    start = time.perf_counter()
+    model = growth(x, y, f, noise=noise, method=method)
+    return model, time.perf_counter() - start
+
+
+def growth_grouped(
+    df,
+    group='type_code',
+    x='age',
+    y='biomass',
+    f=('tmean_mean', 'ppt_mean'),
+    noise='gamma',
+    method='trust-constr',
+    max_workers=None,
+):
+    """
+    fit one growth model per group of df, e.g. per forest type code, on a process pool
+
+    returns a GroupedGrowthModel whose params table has one row per group
+    """
+    tasks = {
+        code: (sub[x].values, sub[y].values, [sub[k].values for k in f])
+        for code, sub in df.groupby(group)
+    }
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            code: pool.submit(_fit_growth_group, *task, noise, method)
+            for code, task in tasks.items()
+        }
+        results = {code: future.result() for code, future in futures.items()}
+
+    models = {code: model for code, (model, _) in results.items()}
+    params = pd.DataFrame(
+        [
+            dict(
+                zip(['a', 'b', 'c', 'w0', 'w1'], model.p),
+                scale=model.scale,
+                train_r2=model.train_r2,
+                iterations=model.result.get('nit'),
+                seconds=seconds,
+                success=bool(model.result.success),
+            )
+            for model, seconds in results.values()
+        ],
+        index=pd.Index(list(results), name=group),
+    )
+    return GroupedGrowthModel(models, params)
+
+
+class GroupedGrowthModel(Mapping):
+    """
+    Per-group GrowthModels, indexable like a dict of group -> model
+
+    params holds a, b, c, w0, w1, scale, train_r2, iterations, fit time and
+    success per group
+    """
+
+    def __init__(self, models, params):
+        self.models = models
+        self.params = params
+
+    def __repr__(self):
+        return f'GroupedGrowthModel(groups={len(self.models)})'
+
+    def __getitem__(self, key):
+        return self.models[key]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+    def _row_params(self, groups):
+        rows = self.params.index.get_indexer(np.asarray(groups))
+        p = self.params[['a', 'b', 'c', 'w0', 'w1']].to_numpy()
+        return np.where((rows >= 0)[:, np.newaxis], p[rows], np.NaN).T
+
+    def predict(self, x, f, groups):
+        """evaluate every row with the parameters of its group, NaN where there is none"""
+        return logistic(np.asarray(x), [np.asarray(v) for v in f], self._row_params(groups))
+
+    def project(self, x, year, f, groups, targets):
+        """
+        project each plot forward to a sequence of target years for a climate ensemble
+
+        x, year and groups are per-plot ages, measurement years and groups. f holds
+        one DataArray per feature with dims (..., 'target', 'plot'), e.g. (gcm,
+        scenario, target, plot). The first target is predicted from the age at that
+        year; each later target adds the change in prediction since the previous
+        target under its own climate, floored at zero. All groups, ensemble members
+        and targets are evaluated with broadcasting and the recursion runs along
+        the target axis.
+        """
+        p = self._row_params(groups)
+        targets = np.asarray(targets, dtype='float64')
+        offset = np.asarray(x) - np.asarray(year)
+        f = [v.transpose(..., 'target', 'plot') for v in f]
+        values = [v.values for v in f]
+
+        age = offset + targets[:, np.newaxis]
+        age[0] = np.maximum(age[0], 0)
+        now = logistic(age, values, p)
+        # later targets under the same climate, aged only to the previous target
+        prev_age = age[1:] - np.diff(targets)[:, np.newaxis]
+        prev = logistic(prev_age, [v[..., 1:, :] for v in values], p)
+        diff = now[..., 1:, :] - prev
+
+        out = np.empty_like(now)
+        out[..., 0, :] = now[..., 0, :]
+        for t in range(1, len(targets)):
+            out[..., t, :] = np.maximum(out[..., t - 1, :] + diff[..., t - 1, :], 0)
+        return xr.DataArray(out, dims=f[0].dims, coords=f[0].coords)
+
+
 class GrowthModel:
     def __init__(self, result, noise, x=None, y=None, f=None):
         self.result = result
         self.noise = noise
+        self.feature_names = None
         self.p = result.x[0 : len(result.x) - 1]
         self.scale = result.x[len(result.x) - 1]
         if x is not None and y is not None and f is not None:
@@ -66,6 +290,39 @@ class GrowthModel:
             f = [np.nanpercentile(f[0], percentile[0]), np.nanpercentile(f[1], percentile[1])]
         return logistic(x, f, self.p)
 
+    def save(self, path, feature_names=None):
+        """
+        write the fitted parameters, noise model, training metrics and optionally
+        the climate feature names to a small .npz file that load reads back
+        """
+        feature_names = self.feature_names if feature_names is None else feature_names
+        meta = {
+            'noise': self.noise,
+            'train_r2': getattr(self, 'train_r2', None),
+            'success': bool(self.result.success),
+            'nit': self.result.get('nit'),
+            'fun': self.result.get('fun'),
+            'message': str(self.result.get('message')),
+            'feature_names': None if feature_names is None else list(feature_names),
+        }
+        write_artifact(path, 'growth', {'x': self.result.x}, meta)
+
+    @classmethod
+    def load(cls, path):
+        """read a model written by save, with a result holding the saved fit summary"""
+        arrays, meta = read_artifact(path, 'growth')
+        result = OptimizeResult(
+            x=arrays['x'],
+            success=meta['success'],
+            nit=meta['nit'],
+            fun=meta['fun'],
+            message=meta['message'],
+        )
+        model = cls(result, meta['noise'])
+        model.train_r2 = meta['train_r2']
+        model.feature_names = meta['feature_names']
+        return model
+
     def sample(self, x, f):
         mu = logistic(x, f, self.p)
         if self.noise == 'gamma':
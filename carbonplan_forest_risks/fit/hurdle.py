@@ -1,11 +1,26 @@
+import os
+import tempfile
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
+from scipy.special import expit
 from sklearn.linear_model import LinearRegression, LogisticRegression, TweedieRegressor
 from sklearn.metrics import roc_auc_score
 
 from ..utils import remove_nans
+from .artifact import read_artifact, write_artifact
+
 
+def hurdle(x, y, log=True, max_iter=1000, init=None):
+    """
+    fit a logistic classifier for y > 0 and a regressor on the positive values
 
-def hurdle(x, y, log=True, max_iter=1000):
+    init is an optional fitted (or loaded) HurdleModel whose coefficients start
+    the iterative solvers (the log-link regressor and the classifier)
+    """
     x, y = remove_nans(x, y)
     n_obs = len(x)
 
@@ -18,18 +33,244 @@ def hurdle(x, y, log=True, max_iter=1000):
     else:
         reg = LinearRegression(fit_intercept=True)
 
+    if init is not None:
+        # go through the compiled coefficients so saved and loaded models work too
+        start = init.compile()
+        clf.set_params(warm_start=True)
+        clf.coef_ = start.coef[np.newaxis, :, 0].copy()
+        clf.intercept_ = start.intercept[:1].copy()
+        if log and init.log:
+            reg.set_params(warm_start=True)
+            reg.coef_ = start.coef[:, 1].copy()
+            reg.intercept_ = start.intercept[1]
+
     clf.fit(x, y > 0)
     reg.fit(x[y > 0, :], y[y > 0])
 
     return HurdleModel(clf, reg, n_obs, log=log, x=x, y=y)
 
 
+def _fit_group(x, y, log=True, max_iter=1000, min_y_sum=None):
+    report = {'n_obs': len(x), 'n_positive': int((y > 0).sum())}
+    start = time.perf_counter()
+    model = None
+    if min_y_sum is not None and not np.nansum(y) > min_y_sum:
+        report['error'] = f'y sums to no more than {min_y_sum}'
+    else:
+        try:
+            model = hurdle(x, y, log=log, max_iter=max_iter)
+        except ValueError as e:
+            report['error'] = str(e)
+    report['seconds'] = time.perf_counter() - start
+    if model is not None:
+        iters = [np.max(model.clf.n_iter_), np.max(getattr(model.reg, 'n_iter_', 0))]
+        report['converged'] = bool(max(iters) < max_iter)
+    return model, report
+
+
+def hurdle_grouped(
+    x, y, groups, log=True, max_iter=1000, min_y_sum=None, max_workers=None, processes=False
+):
+    """
+    fit one hurdle model per group, e.g. per forest type code
+
+    Rows are sorted by group once and each group's contiguous slice is fit on a
+    thread pool (or a process pool with processes=True). Groups whose fit fails,
+    or whose y sums to no more than min_y_sum, get no model; the reason is kept
+    in the fitting report. Rows with a missing group are not fit and are reported
+    as a NaN group.
+    """
+    groups = np.asarray(groups)
+    missing = pd.isna(groups)
+    n_missing = int(missing.sum())
+    if n_missing:
+        x, y, groups = x[~missing], y[~missing], groups[~missing]
+    order = np.argsort(groups, kind='stable')
+    codes, starts = np.unique(groups[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    x = x[order]
+    y = y[order]
+
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_fit_group, x[a:b], y[a:b], log, max_iter, min_y_sum)
+            for a, b in zip(starts, stops)
+        ]
+        results = [future.result() for future in futures]
+
+    models = {code: model for code, (model, _) in zip(codes, results) if model is not None}
+    reports = [report for _, report in results]
+    index = pd.Index(codes, name='group')
+    if n_missing:
+        reports.append({'n_obs': n_missing, 'error': 'missing group'})
+        index = index.append(pd.Index([np.NaN], name='group'))
+    report = pd.DataFrame(
+        reports,
+        index=index,
+        columns=['n_obs', 'n_positive', 'seconds', 'converged', 'error'],
+    )
+    return GroupedHurdleModel(models, report)
+
+
+_shared = {}
+
+
+def _load_shared(x_path, y_path, rows_path):
+    _shared['x'] = np.load(x_path, mmap_mode='r')
+    _shared['y'] = np.load(y_path, mmap_mode='r')
+    _shared['rows'] = np.load(rows_path, mmap_mode='r')
+
+
+def _fit_fold(fold, log, max_iter, init):
+    # x holds only the complete rows, at positions rows of the full layout
+    x = _shared['x']
+    y = _shared['y']
+    rows = _shared['rows']
+    if isinstance(fold, BlockFold):
+        train = fold.rows(len(y))
+        y = fold.target(y)
+    else:
+        train, fold_y = fold
+        if fold_y is not None:
+            y = fold_y
+        if train is not None:
+            mask = np.zeros(len(y), dtype=bool)
+            mask[train] = True
+            train = mask
+    y = np.asarray(y)[rows]
+    keep = np.isfinite(y)
+    if train is not None:
+        keep &= train[rows]
+    if not keep.all():
+        # only the fold's own training rows are copied out of the shared x
+        x = x[keep]
+        y = y[keep]
+    return hurdle(np.asarray(x), y, log=log, max_iter=max_iter, init=init)
+
+
+def hurdle_folds(x, y, folds, log=True, max_iter=1000, init=None, max_workers=None):
+    """
+    fit one hurdle model per fold on a process pool, e.g. for cross validation
+
+    Each fold is a BlockFold, or a (train, y) pair: train is a boolean mask or
+    index array of rows to fit on and y an alternate target such as a shuffled
+    one, either may be None to use all rows or the shared y. Rows of x with
+    missing values are dropped once, then x and y are written to memory-mapped
+    files that every worker opens read-only, so they are not pickled per fold
+    and a fold on all rows fits on the shared x without copying it. BlockFolds
+    let workers build their own masks and shuffled targets. init warm-starts
+    every fit, e.g. from the full-data model.
+    """
+    complete = np.isnan(x).sum(axis=1) == 0
+    with tempfile.TemporaryDirectory() as tmp:
+        x_path = os.path.join(tmp, 'x.npy')
+        y_path = os.path.join(tmp, 'y.npy')
+        rows_path = os.path.join(tmp, 'rows.npy')
+        np.save(x_path, x if complete.all() else x[complete])
+        np.save(y_path, y)
+        np.save(rows_path, np.flatnonzero(complete))
+        del complete
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_load_shared,
+            initargs=(x_path, y_path, rows_path),
+        ) as pool:
+            futures = [pool.submit(_fit_fold, fold, log, max_iter, init) for fold in folds]
+            return [future.result() for future in futures]
+
+
+class BlockFold:
+    """
+    Compact description of a fold over rows laid out in equal contiguous blocks,
+    e.g. the time steps of a flattened (time, y, x) grid
+
+    train lists the blocks to fit on (None for all of them), order reorders the
+    blocks of y (e.g. shuffled months or years) and seed shuffles all rows of y.
+    Only these few integers are sent to a worker, which builds the row mask and
+    the target itself; the same fold rebuilds them for scoring.
+    """
+
+    def __init__(self, n_blocks, train=None, order=None, seed=None):
+        self.n_blocks = n_blocks
+        self.train = None if train is None else np.asarray(train)
+        self.order = None if order is None else np.asarray(order)
+        self.seed = seed
+
+    def __repr__(self):
+        train = 'all' if self.train is None else len(self.train)
+        return f'BlockFold(n_blocks={self.n_blocks}, train={train}, seed={self.seed})'
+
+    def blocks(self, selection, n):
+        """boolean mask of the rows in the blocks of selection"""
+        blocks = np.zeros(self.n_blocks, dtype=bool)
+        blocks[selection] = True
+        return np.repeat(blocks, n // self.n_blocks)
+
+    def rows(self, n):
+        """boolean mask of the rows to fit on, or None for all rows"""
+        if self.train is None:
+            return None
+        return self.blocks(self.train, n)
+
+    def target(self, y):
+        """y with its blocks reordered and its rows shuffled as the fold asks"""
+        if self.order is not None:
+            y = np.asarray(y).reshape(self.n_blocks, -1)[self.order].reshape(-1)
+        if self.seed is not None:
+            y = np.random.default_rng(self.seed).permutation(y)
+        return y
+
+
+class GroupedHurdleModel(Mapping):
+    """
+    Per-group HurdleModels, indexable like a dict of group -> model
+
+    report holds n_obs, n_positive, fit time, convergence and any error per group
+    """
+
+    def __init__(self, models, report=None):
+        self.models = models
+        self.report = report
+
+    def __repr__(self):
+        return f'GroupedHurdleModel(groups={len(self.models)})'
+
+    def __getitem__(self, key):
+        return self.models[key]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+    def predict(self, x, groups, kind='predict'):
+        """score every row of x with the model for its group, NaN where there is none"""
+        groups = np.asarray(groups)
+        order = np.argsort(groups, kind='stable')
+        codes, starts = np.unique(groups[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        out = np.full(len(x), np.NaN)
+        for code, a, b in zip(codes, starts, stops):
+            if code in self.models:
+                rows = order[a:b]
+                out[rows] = self.models[code].compile().score(x[rows], kind=kind)
+        return out
+
+
 class HurdleModel:
+    # set by load from a saved model; fitted models keep the sklearn estimators instead
+    _scorer = None
+
     def __init__(self, clf, reg, n_obs, log=None, x=None, y=None):
         self.clf = clf
         self.reg = reg
         self.log = log
         self.n_obs = n_obs
+        self.feature_names = None
+        self.x_mean = None
+        self.x_std = None
         if x is not None and y is not None:
             self.train_r2 = np.corrcoef(self.predict_linear(x)[y > 0], y[y > 0])[0, 1] ** 2
             self.train_roc = roc_auc_score(y > 0, self.predict_prob(x))
@@ -46,6 +287,8 @@ class HurdleModel:
         return np.corrcoef(self.predict_linear(x)[y > 0], y[y > 0])[0, 1] ** 2
 
     def predict_binary(self, x):
+        if self._scorer is not None:
+            return self._scorer.score(x, kind='binary')
         out = np.ones(len(x)) * np.NaN
         x, inds = remove_nans(x, return_inds=True)
         prediction = self.clf.predict(x) * self.reg.predict(x)
@@ -53,6 +296,8 @@ class HurdleModel:
         return out
 
     def predict(self, x):
+        if self._scorer is not None:
+            return self._scorer.score(x, kind='predict')
         out = np.ones(len(x)) * np.NaN
         x, inds = remove_nans(x, return_inds=True)
         prediction = self.clf.predict_proba(x)[:, 1] * self.reg.predict(x)
@@ -60,6 +305,8 @@ class HurdleModel:
         return out
 
     def predict_prob(self, x):
+        if self._scorer is not None:
+            return self._scorer.score(x, kind='prob')
         out = np.ones(len(x)) * np.NaN
         x, inds = remove_nans(x, return_inds=True)
         prediction = self.clf.predict_proba(x)[:, 1]
@@ -67,8 +314,143 @@ class HurdleModel:
         return out
 
     def predict_linear(self, x):
+        if self._scorer is not None:
+            return self._scorer.score(x, kind='linear')
         out = np.ones(len(x)) * np.NaN
         x, inds = remove_nans(x, return_inds=True)
         prediction = self.reg.predict(x)
         out[inds] = prediction
         return out
+
+    def compile(self):
+        """return an array-backed HurdleScorer holding only the fitted coefficients"""
+        if self._scorer is not None:
+            return self._scorer
+        coef = np.stack([np.ravel(self.clf.coef_), np.ravel(self.reg.coef_)], axis=1)
+        intercept = np.array([np.ravel(self.clf.intercept_)[0], np.ravel(self.reg.intercept_)[0]])
+        return HurdleScorer(coef, intercept, log=self.log)
+
+    def save(self, path, feature_names=None, x_mean=None, x_std=None):
+        """
+        write the model to a small .npz file that load reads back without refitting
+
+        Stores the coefficients, link, training metrics and, when given here or
+        set on the model, the feature names and the z-score mean and std that
+        inputs must be standardized with. path can be any fsspec url.
+        """
+        scorer = self.compile()
+        feature_names = self.feature_names if feature_names is None else feature_names
+        meta = {
+            'log': bool(self.log),
+            'n_obs': int(self.n_obs),
+            'train_r2': getattr(self, 'train_r2', None),
+            'train_roc': getattr(self, 'train_roc', None),
+            'feature_names': None if feature_names is None else list(feature_names),
+        }
+        arrays = {
+            'coef': scorer.coef,
+            'intercept': scorer.intercept,
+            'x_mean': self.x_mean if x_mean is None else x_mean,
+            'x_std': self.x_std if x_std is None else x_std,
+        }
+        write_artifact(path, 'hurdle', arrays, meta)
+
+    @classmethod
+    def load(cls, path):
+        """read a model written by save; it predicts through its compiled HurdleScorer"""
+        arrays, meta = read_artifact(path, 'hurdle')
+        model = cls(None, None, meta['n_obs'], log=meta['log'])
+        model._scorer = HurdleScorer(arrays['coef'], arrays['intercept'], log=meta['log'])
+        model.train_r2 = meta['train_r2']
+        model.train_roc = meta['train_roc']
+        model.feature_names = meta['feature_names']
+        model.x_mean = arrays.get('x_mean')
+        model.x_std = arrays.get('x_std')
+        return model
+
+    def predict_blocks(self, x, out=None, kind='predict', block_size=2**16, max_workers=None):
+        """
+        predict in fixed-size row blocks, writing into out
+
+        Equivalent to predict, predict_prob, predict_linear or predict_binary
+        (kind='predict', 'prob', 'linear' or 'binary'), but each block needs only one
+        matrix product and rows with NaNs come out as NaN without building a
+        compacted copy of x. Blocks run on a thread pool when max_workers > 1.
+        """
+        scorer = self.compile()
+        if kind not in scorer.kinds:
+            raise ValueError(f"prediction kind='{kind}' not implemented")
+        if out is None:
+            out = np.empty(len(x))
+
+        def predict_block(start):
+            block = slice(start, start + block_size)
+            out[block] = scorer.score(x[block], kind=kind)
+
+        starts = range(0, len(x), block_size)
+        if max_workers is None or max_workers <= 1:
+            for start in starts:
+                predict_block(start)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(predict_block, starts))
+        return out
+
+
+class HurdleScorer:
+    """
+    Compact, array-backed form of a fitted HurdleModel
+
+    Holds the classifier and regressor coefficients as the columns of one
+    (n_features, 2) matrix, so scoring is a single matrix product followed by
+    sigmoid(z_c) * link(z_r) without any sklearn input validation. Rows of x
+    containing NaNs score as NaN, as with the HurdleModel predict methods.
+    """
+
+    kinds = ['predict', 'prob', 'linear', 'binary']
+
+    def __init__(self, coef, intercept, log=False):
+        self.coef = np.asarray(coef, dtype='float64')
+        self.intercept = np.asarray(intercept, dtype='float64')
+        self.log = log
+
+    def __repr__(self):
+        return f"HurdleScorer(n_features={len(self.coef)}, link='{self.log}')"
+
+    def __call__(self, x):
+        return self.predict(x)
+
+    def linear_terms(self, x):
+        z = np.asarray(x) @ self.coef
+        z += self.intercept
+        return z
+
+    def _link(self, z):
+        return np.exp(z) if self.log else z
+
+    def score(self, x, kind='predict'):
+        z = self.linear_terms(x)
+        if kind == 'prob':
+            return expit(z[:, 0])
+        if kind == 'linear':
+            return self._link(z[:, 1])
+        if kind == 'binary':
+            prob = (z[:, 0] > 0).astype(z.dtype)
+            prob[np.isnan(z[:, 0])] = np.NaN
+        elif kind == 'predict':
+            prob = expit(z[:, 0])
+        else:
+            raise ValueError(f"prediction kind='{kind}' not implemented")
+        return prob * self._link(z[:, 1])
+
+    def predict(self, x):
+        return self.score(x, kind='predict')
+
+    def predict_prob(self, x):
+        return self.score(x, kind='prob')
+
+    def predict_linear(self, x):
+        return self.score(x, kind='linear')
+
+    def predict_binary(self, x):
+        return self.score(x, kind='binary')
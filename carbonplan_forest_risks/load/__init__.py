@@ -1,9 +1,9 @@
 # flake8: noqa
-from .cmip import cmip
-from .fia import fia
+from .cmip import cmip, cmip_prefix, cmip_time
+from .fia import fia, fia_paths
 from .mask import mask
 from .mtbs import mtbs
-from .nftd import nftd
-from .nlcd import nlcd
-from .terraclim import terraclim
+from .nftd import nftd, nftd_paths
+from .nlcd import nlcd, nlcd_paths
+from .terraclim import terraclim, terraclim_prefix
 from .tiff import impacts, tiff
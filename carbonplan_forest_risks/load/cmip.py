@@ -1,12 +1,8 @@
 import warnings
 
-import fsspec
 import numpy as np
 import xarray as xr
 import zarr
-from pyproj import Proj, transform
-from rasterio import Affine
-from rasterio.transform import rowcol
 from tenacity import retry, stop_after_attempt
 
 from .. import setup, utils
@@ -21,6 +17,44 @@ members = {
 }
 
 
+def cmip_prefix(model, scenario, member=None, method='bias-corrected', sampling='annual'):
+    """path of a downscaled cmip zarr store within the carbonplan-downscaling container"""
+    if member is None:
+        member = members[model]
+    return f'cmip6/{method}/conus/4000m/{sampling}/{model}.{scenario}.{member}.zarr'
+
+
+def _open_cmip(store, prefix):
+    if store == 'az':
+        mapper = zarr.storage.ABSStore(
+            'carbonplan-downscaling', prefix=prefix, account_name='carbonplan'
+        )
+    else:
+        mapper = setup.get_mapper(setup.loading(store) / 'carbonplan-downscaling' / prefix)
+    return xr.open_zarr(mapper, consolidated=True)
+
+
+@retry(stop=stop_after_attempt(5))
+def cmip_time(
+    store='az',
+    model=None,
+    scenario=None,
+    member=None,
+    method='bias-corrected',
+    sampling='annual',
+    historical=False,
+    tlim=None,
+):
+    """time coordinate cmip would return for these arguments, read without loading any data"""
+    time = _open_cmip(store, cmip_prefix(model, scenario, member, method, sampling))['time']
+    if historical:
+        prefix = cmip_prefix(model, 'historical', member, method, sampling)
+        time = xr.concat([_open_cmip(store, prefix)['time'], time], 'time')
+    if tlim is not None:
+        time = time.sel(time=slice(*map(str, tlim)))
+    return time
+
+
 @retry(stop=stop_after_attempt(5))
 def cmip(
     store='az',
@@ -36,6 +70,9 @@ def cmip(
     sampling='annual',
     historical=False,
     remove_nans=False,
+    points=None,
+    gather='isel',
+    max_workers=None,
 ):
 
     with warnings.catch_warnings():
@@ -50,31 +87,11 @@ def cmip(
         if member is None:
             member = members[model]
 
-
-        path = setup.loading(store)
-
-        prefix = f'cmip6/{method}/conus/4000m/{sampling}/{model}.{scenario}.{member}.zarr'
-
-        if store == 'az':
-            mapper = zarr.storage.ABSStore(
-                'carbonplan-downscaling', prefix=prefix, account_name='carbonplan'
-            )
-        else:
-            mapper = fsspec.get_mapper((path / 'carbonplan-downscaling' / prefix).as_uri())
-
-        ds = xr.open_zarr(mapper, consolidated=True)
+        ds = _open_cmip(store, cmip_prefix(model, scenario, member, method, sampling))
 
         if historical:
-            prefix = f'cmip6/{method}/conus/4000m/{sampling}/{model}.historical.{member}.zarr'
-
-            if store == 'az':
-                mapper = zarr.storage.ABSStore(
-                    'carbonplan-downscaling', prefix=prefix, account_name='carbonplan'
-                )
-            else:
-                mapper = fsspec.get_mapper((path / 'carbonplan-downscaling' / prefix).as_uri())
-
-            ds_historical = xr.open_zarr(mapper, consolidated=True)
+            prefix = cmip_prefix(model, 'historical', member, method, sampling)
+            ds_historical = _open_cmip(store, prefix)
 
             ds = xr.concat([ds_historical, ds], 'time')
 
@@ -103,19 +120,16 @@ def cmip(
             X = X_coarse
 
         if df is not None:
-            t = Affine(*utils.albers_conus_transform(4000))
-            p1 = Proj(utils.albers_conus_crs())
-            p2 = Proj(proj='latlong', datum='WGS84')
-            x, y = transform(p2, p1, df['lon'].values, df['lat'].values)
-            rc = rowcol(t, x, y)
-            ind_r = xr.DataArray(rc[0], dims=['c'])
-            ind_c = xr.DataArray(rc[1], dims=['c'])
-
-            base = X[keys].isel(y=ind_r, x=ind_c).load()
+            if points is None:
+                points = utils.PointIndex.from_df(df)
+            elif len(points) != len(df):
+                raise ValueError('points must index the same rows as df')
+
+            base = points.gather(X[keys], method=gather, max_workers=max_workers)
             for key in keys:
-                df[key + '_mean'] = base[key].mean('time').values
-                df[key + '_min'] = base[key].min('time').values
-                df[key + '_max'] = base[key].max('time').values
+                df[key + '_mean'] = points.expand(base[key].mean('time').values)
+                df[key + '_min'] = points.expand(base[key].min('time').values)
+                df[key + '_max'] = points.expand(base[key].max('time').values)
             if remove_nans:
                 for key in keys:
                     df = df[~np.isnan(df[key + '_mean'])]
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 from tenacity import retry, stop_after_attempt
@@ -229,8 +231,53 @@ conus_states = [
     'WY',
 ]
 
+# remeasured variables spread into {var}_{i} columns by fia_state_grouped
+repeat_vars = [
+    'year',
+    'balive',
+    'mort',
+    'frac_pop_mort_insect',
+    'frac_pop_mort_disease',
+    'frac_pop_mort_fire',
+    'frac_pop_mort_animal',
+    'frac_pop_mort_weather',
+    'frac_pop_mort_vegetation',
+    'frac_pop_mort_unknown',
+    'disturb_animal',
+    'disturb_insect',
+    'disturb_disease',
+    'disturb_fire',
+    'disturb_human',
+    'disturb_weather',
+    'treatment_cutting',
+    'treatment_regeneration',
+    'treatment_preparation',
+    'treatment_other',
+]
+
+# raw long-format columns used by fia_state, in output order
+fia_state_columns = {
+    'LAT': 'lat',
+    'LON': 'lon',
+    'STDAGE': 'age',
+    'adj_ag_biomass': 'biomass',
+    'MEASYEAR': 'year',
+    'INVYR': 'inventory_year',
+    'FLDTYPCD': 'type_code',
+    'ELEV': 'elevation',
+    'SLOPE': 'slope',
+    'ASPECT': 'aspect',
+    'adj_pop_mort': 'mort',
+    'OWNCD': 'owner',
+    'PLT_CN': 'plot_cn',
+    'ACTUALHT': 'height',
+    'PHYSCLCD': 'physiographic_code',
+    'ALSTKCD': 'all_stocking_code',
+    'GSSTKCD': 'grow_stocking_code',
+}
 
-def fia(store='az', states='conus', clean=True, group_repeats=False):
+
+def fia(store='az', states='conus', clean=True, group_repeats=False, max_workers=None):
     if states == 'conus':
         states = conus_states
 
@@ -240,7 +287,9 @@ def fia(store='az', states='conus', clean=True, group_repeats=False):
         df = load_state(store, states, clean)
 
     if type(states) is list:
-        df = pd.concat([load_state(store, state, clean) for state in states])
+        # state files are independent, so read them concurrently and keep the input order
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            df = pd.concat(pool.map(lambda state: load_state(store, state, clean), states))
 
     if group_repeats:
         # TODO this is to drop columns added due to missing data
@@ -253,11 +302,43 @@ def fia(store='az', states='conus', clean=True, group_repeats=False):
     return df
 
 
+def fia_paths(states='conus'):
+    """paths of the long-format state parquet files fia reads, relative to the store root"""
+    if states == 'conus':
+        states = conus_states
+    if type(states) is str:
+        states = [states]
+    return [
+        f'carbonplan-data/processed/fia-states/long/{state.lower()}.parquet' for state in states
+    ]
+
+
 @retry(stop=stop_after_attempt(7))
 def fia_state(store, state, clean):
     path = setup.loading(store)
+
+    # push the column projection and the simple bounds down into the parquet reader,
+    # every pushed predicate also drops NaNs so the pandas masks below stay exact
+    if clean:
+        filters = [
+            ('STDAGE', '<', 999),
+            ('STDAGE', '>', 0),
+            ('FLDTYPCD', '<=', 983),
+            ('MEASYEAR', '<', 9999),
+            ('MEASYEAR', '>', 2000),
+            ('INVYR', '<', 9999),
+            ('INVYR', '>', 2000),
+        ]
+    else:
+        filters = [
+            ('MEASYEAR', '<', 9999),
+            ('INVYR', '<', 9999),
+            ('FLDTYPCD', '<=', 983),
+        ]
     df = pd.read_parquet(
-        path / f'carbonplan-data/processed/fia-states/long/{state.lower()}.parquet'
+        path / fia_paths(state)[0],
+        columns=list(fia_state_columns) + ['DSTRBCD1', 'COND_STATUS_CD', 'CONDPROP_UNADJ'],
+        filters=filters,
     )
 
     if clean:
@@ -288,47 +369,7 @@ def fia_state(store, state, clean):
         )
         df = df[inds]
 
-    df = df.rename(
-        columns={
-            'LAT': 'lat',
-            'LON': 'lon',
-            'adj_ag_biomass': 'biomass',
-            'adj_pop_mort': 'mort',
-            'STDAGE': 'age',
-            'ACTUALHT': 'height',
-            'MEASYEAR': 'year',
-            'INVYR': 'inventory_year',
-            'FLDTYPCD': 'type_code',
-            'PHYSCLCD': 'physiographic_code',
-            'ALSTKCD': 'all_stocking_code',
-            'GSSTKCD': 'grow_stocking_code',
-            'ELEV': 'elevation',
-            'SLOPE': 'slope',
-            'ASPECT': 'aspect',
-            'OWNCD': 'owner',
-            'PLT_CN': 'plot_cn',
-        }
-    ).filter(
-        [
-            'lat',
-            'lon',
-            'age',
-            'biomass',
-            'year',
-            'inventory_year',
-            'type_code',
-            'elevation',
-            'slope',
-            'aspect',
-            'mort',
-            'owner',
-            'plot_cn',
-            'height',
-            'physiographic_code',
-            'all_stocking_code',
-            'grow_stocking_code',
-        ]
-    )
+    df = df.rename(columns=fia_state_columns).filter(list(fia_state_columns.values()))
 
     df['type_code'] = df['type_code'].map(forest_type_remap)
 
@@ -344,9 +385,7 @@ def fia_state_grouped(store, state, clean):
     related plot-condition invyrs into a single row
     """
     path = setup.loading(store)
-    state_long = pd.read_parquet(
-        path / f'carbonplan-data/processed/fia-states/long/{state.lower()}.parquet'
-    )
+    state_long = pd.read_parquet(path / fia_paths(state)[0])
 
     state_long = state_long.rename(
         columns={
@@ -372,37 +411,10 @@ def fia_state_grouped(store, state, clean):
     )
 
     state_long = state_long.sort_values(['plt_uid', 'CONDID', 'year'])
-    state_long['wide_idx'] = state_long.groupby(['plt_uid', 'CONDID']).cumcount()
-    tmp = []
-    missing_vars = []  # append missing vars, then will fill in nan cols after concat the wide df
-    for var in [
-        'year',
-        'balive',
-        'mort',
-        'frac_pop_mort_insect',
-        'frac_pop_mort_disease',
-        'frac_pop_mort_fire',
-        'frac_pop_mort_animal',
-        'frac_pop_mort_weather',
-        'frac_pop_mort_vegetation',
-        'frac_pop_mort_unknown',
-        'disturb_animal',
-        'disturb_insect',
-        'disturb_disease',
-        'disturb_fire',
-        'disturb_human',
-        'disturb_weather',
-        'treatment_cutting',
-        'treatment_regeneration',
-        'treatment_preparation',
-        'treatment_other',
-    ]:
-        state_long['tmp_idx'] = var + '_' + state_long['wide_idx'].astype(str)
-        if var in state_long.columns:
-            tmp.append(state_long.pivot(index=['plt_uid', 'CONDID'], columns='tmp_idx', values=var))
-        else:
-            missing_vars.append(var)
-    wide = pd.concat(tmp, axis=1)
+    present = [var for var in repeat_vars if var in state_long.columns]
+    # append missing vars, then will fill in nan cols after building the wide df
+    missing_vars = [var for var in repeat_vars if var not in state_long.columns]
+    wide = pivot_repeats(state_long, ['plt_uid', 'CONDID'], present)
 
     if missing_vars:
         for missing_var in missing_vars:
@@ -445,7 +457,7 @@ def fia_state_grouped(store, state, clean):
         if key in df.columns:
             if clean:
                 df = df[(df[key] < 9999) | np.isnan((df[key]))]
-            if sum(np.isnan(df[key])) == len(df):
+            if df[key].isna().all():
                 del df[key]
 
     df['type_code'] = df['type_code'].map(forest_type_remap)
@@ -453,3 +465,52 @@ def fia_state_grouped(store, state, clean):
     df['state'] = state.upper()
 
     return df.reset_index(drop=True)
+
+
+def pivot_repeats(long, keys, variables):
+    """
+    Reshape remeasurements from long (one row per measurement) to wide
+    (``{var}_{i}`` columns per group) in a single pass
+
+    ``long`` must already be sorted by ``keys``; the i-th row of each group
+    becomes repeat ``i``. Groups are found once from the sorted keys and every
+    variable is scattered into one preallocated (group, repeat, var) array, so
+    the result matches calling ``pivot`` per variable without re-hashing the
+    index for each one.
+    """
+    long = long.dropna(subset=keys)
+    key_values = [long[key].to_numpy() for key in keys]
+    n = len(long)
+    new_group = np.zeros(n, dtype=bool)
+    new_group[:1] = True
+    for values in key_values:
+        new_group[1:] |= values[1:] != values[:-1]
+    starts = np.flatnonzero(new_group)
+    group = np.cumsum(new_group) - 1
+    repeat = np.arange(n) - starts[group]
+    counts = np.diff(np.append(starts, n))
+    n_groups, max_repeats = len(starts), int(counts.max()) if n else 0
+
+    array = np.full((n_groups, max_repeats, len(variables)), np.nan)
+    for j, var in enumerate(variables):
+        array[group, repeat, j] = long[var].to_numpy(dtype='float64', na_value=np.nan)
+
+    complete = bool((counts == max_repeats).all())
+    index = pd.MultiIndex.from_arrays([values[starts] for values in key_values], names=keys)
+    # pivot orders its columns as strings, e.g. year_1, year_10, year_2
+    order = sorted(range(max_repeats), key=str)
+    columns = {}
+    for j, var in enumerate(variables):
+        dtype = long[var].dtype
+        for i in order:
+            values = array[:, i, j]
+            if dtype.kind in 'bO':
+                # missing cells upcast bool columns to object, as pivot would
+                out = np.full(n_groups, np.nan, dtype=object)
+                valid = ~np.isnan(values)
+                out[valid] = values[valid].astype(bool)
+                values = out.astype(bool) if complete else out
+            elif dtype.kind in 'iu' and complete:
+                values = values.astype(dtype)
+            columns[f'{var}_{i}'] = values
+    return pd.DataFrame(columns, index=index)
@@ -1,6 +1,5 @@
 import warnings
 
-import fsspec
 import numpy as np
 import xarray as xr
 
@@ -10,8 +9,7 @@ from .. import setup
 def mtbs(store='az', tlim=(1984, 2018), mask=None, coarsen=None):
     path = setup.loading(store)
 
-    prefix = (path / 'carbonplan-data/processed/mtbs/conus/4000m/monthly.zarr').as_uri()
-    mapper = fsspec.get_mapper(prefix)
+    mapper = setup.get_mapper(path / 'carbonplan-data/processed/mtbs/conus/4000m/monthly.zarr')
 
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
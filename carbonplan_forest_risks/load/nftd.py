@@ -4,75 +4,144 @@ import xarray as xr
 
 from .. import setup
 
+NFTD_GROUPS = [
+    100,
+    120,
+    140,
+    160,
+    180,
+    200,
+    220,
+    240,
+    260,
+    280,
+    300,
+    320,
+    340,
+    360,
+    370,
+    400,
+    500,
+    600,
+    700,
+    800,
+    900,
+    910,
+    920,
+    940,
+    950,
+]
+
+_merges = {}
+
 
 def load_rio(f):
     src = rasterio.open(f)
     return src.read(1)
 
 
-def nftd(store='az', groups='all', coarsen=None, append_all=False, mask=None, area_threshold=None):
-    path = setup.loading(store)
+def nftd_paths(groups='all'):
+    """paths of the tiffs nftd reads for groups, relative to the store root"""
+    if groups == 'all':
+        groups = NFTD_GROUPS
+    return [f'carbonplan-data/processed/nftd/conus/4000m/group_g{g}.tif' for g in groups]
+
+
+def small_band_merges(bands, area_threshold):
+    """
+    map each band whose total area is below area_threshold to the large band it
+    correlates with best, over the pixels where both are defined
+
+    Areas are row sums of one (bands, pixels) matrix, and the pairwise moments of
+    every small band against every large band come from a single matrix product
+    of the stacked [valid, x, x**2] rows, so no band is flattened more than once.
+    """
+    band_inds = bands['band'].values
+    values = bands.values.reshape(len(band_inds), -1)
+    valid = ~np.isnan(values)
+    areas = np.where(valid, values, 0).sum(axis=1, dtype='float64')
+    small = areas < area_threshold
+    if not small.any():
+        return {}
+
+    # shifting each band by its mean leaves the correlations unchanged but keeps
+    # the raw moments below small enough to difference accurately
+    counts = valid.sum(axis=1)
+    means = areas / np.maximum(counts, 1)
+    x = np.where(valid, values - means[:, np.newaxis], 0)
+    m = valid.astype('float64')
+    moments = lambda rows: np.concatenate([m[rows], x[rows], x[rows] ** 2])
+    products = moments(small) @ moments(~small).T
+
+    ns, nl = small.sum(), (~small).sum()
+    block = lambda i, j: products[i * ns : (i + 1) * ns, j * nl : (j + 1) * nl]
+    n, sx, sy = block(0, 0), block(1, 0), block(0, 1)
+    sxy, sxx, syy = block(1, 1), block(2, 0), block(0, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corrs = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx**2) * (n * syy - sy**2))
 
+    targets = band_inds[~small][np.argmax(corrs, axis=1)]
+    return dict(zip(band_inds[small].tolist(), targets.tolist()))
+
+
+def merge_bands(bands, merges):
+    """add each source band of merges into its target band and drop the sources"""
+    if not merges:
+        return bands
+    band_inds = bands['band'].values.tolist()
+    keep = ~np.isin(band_inds, list(merges))
+    position = {band: i for i, band in enumerate(np.asarray(band_inds)[keep].tolist())}
+    sources = [band_inds.index(source) for source in merges]
+    targets = [position[target] for target in merges.values()]
+    values = bands.values
+    merged = values[keep]
+    np.add.at(merged, targets, values[sources])
+    return bands[keep].copy(data=merged)
+
+
+def nftd(
+    store='az',
+    groups='all',
+    coarsen=None,
+    append_all=False,
+    mask=None,
+    area_threshold=None,
+    cache=True,
+):
+    """forest type fractions along 'band', cached by setup.cache.LayerCache unless cache=False"""
     if groups == 'all':
-        groups = [
-            100,
-            120,
-            140,
-            160,
-            180,
-            200,
-            220,
-            240,
-            260,
-            280,
-            300,
-            320,
-            340,
-            360,
-            370,
-            400,
-            500,
-            600,
-            700,
-            800,
-            900,
-            910,
-            920,
-            940,
-            950,
-        ]
+        groups = NFTD_GROUPS
+
+    build = lambda: _nftd(store, groups, coarsen, append_all, mask, area_threshold)
+    if not cache:
+        return build()
+    if cache is True:
+        cache = setup.layer_cache()
+    params = {
+        'store': store,
+        'groups': [int(g) for g in groups],
+        'coarsen': coarsen,
+        'append_all': append_all,
+        'area_threshold': area_threshold,
+    }
+    sources = [setup.store_url(store, f) for f in nftd_paths(groups)]
+    return cache.get('nftd', params, build, mask=mask, sources=sources)
+
+
+def _nftd(store, groups, coarsen, append_all, mask, area_threshold):
+    path = setup.loading(store)
 
     bands = xr.concat(
-        [
-            xr.open_rasterio(
-                (path / f'carbonplan-data/processed/nftd/conus/4000m/group_g{g}.tif').as_uri()
-            )[0]
-            for g in groups
-        ],
+        [xr.open_rasterio((path / f).as_uri())[0] for f in nftd_paths(groups)],
         dim=xr.Variable('band', groups),
     )
 
     if area_threshold is not None:
-        band_inds = bands['band'].values
-        areas = np.asarray([bands.sel(band=band).sum(['x', 'y']).item() for band in band_inds])
-        small_inds = areas < area_threshold
-        large_inds = areas >= area_threshold
-        matches = {}
-
-        for band in band_inds[small_inds]:
-            corrs = []
-            for other in band_inds[~small_inds]:
-                x = bands.sel(band=band).values.flatten()
-                y = bands.sel(band=other).values.flatten()
-                notnan = ~np.isnan(x) & ~np.isnan(y)
-                corrs.append(np.corrcoef(x[notnan], y[notnan])[0, 1])
-            ind = np.argmax(corrs)
-            matches[band] = band_inds[~small_inds][ind]
-
-        for source, target in matches.items():
-            bands.loc[target] += bands.loc[source]
-
-        bands = bands[large_inds]
+        # the merges depend only on the full resolution bands, so coarsen and mask can vary
+        key = (store, tuple(int(g) for g in groups), area_threshold)
+        if key not in _merges:
+            _merges[key] = small_band_merges(bands, area_threshold)
+        bands = merge_bands(bands, _merges[key])
 
     if append_all:
         total = bands.sum('band').values[np.newaxis, :, :]
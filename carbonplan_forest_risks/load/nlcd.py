@@ -3,20 +3,41 @@ import xarray as xr
 
 from .. import setup
 
+NLCD_CLASSES = [11, 12, 21, 22, 23, 24, 31, 41, 42, 43, 51, 52, 71, 72, 73, 74, 81, 82, 90, 95]
 
-def nlcd(store='az', classes='all', year=2001, coarsen=None, mask=None):
-    path = setup.loading(store)
 
+def nlcd_paths(classes='all', year=2001):
+    """paths of the tiffs nlcd reads for classes and year, relative to the store root"""
     if classes == 'all':
-        classes = [11, 12, 21, 22, 23, 24, 31, 41, 42, 43, 51, 52, 71, 72, 73, 74, 81, 82, 90, 95]
+        classes = NLCD_CLASSES
+    return [f'carbonplan-data/processed/nlcd/conus/4000m/{year}_c{c}.tif' for c in classes]
+
+
+def nlcd(store='az', classes='all', year=2001, coarsen=None, mask=None, cache=True):
+    """land cover fractions along 'band', cached by setup.cache.LayerCache unless cache=False"""
+    if classes == 'all':
+        classes = NLCD_CLASSES
+
+    build = lambda: _nlcd(store, classes, year, coarsen, mask)
+    if not cache:
+        return build()
+    if cache is True:
+        cache = setup.layer_cache()
+    params = {
+        'store': store,
+        'classes': [int(c) for c in classes],
+        'year': int(year),
+        'coarsen': coarsen,
+    }
+    sources = [setup.store_url(store, f) for f in nlcd_paths(classes, year)]
+    return cache.get('nlcd', params, build, mask=mask, sources=sources)
+
+
+def _nlcd(store, classes, year, coarsen, mask):
+    path = setup.loading(store)
 
     bands = xr.concat(
-        [
-            xr.open_rasterio(
-                (path / f'carbonplan-data/processed/nlcd/conus/4000m/{year}_c{c}.tif').as_uri()
-            )
-            for c in classes
-        ],
+        [xr.open_rasterio((path / f).as_uri()) for f in nlcd_paths(classes, year)],
         dim=xr.Variable('band', classes),
     )
 
@@ -1,17 +1,18 @@
 import warnings
 
-import fsspec
 import numpy as np
 import xarray as xr
 import zarr
-from pyproj import Proj, transform
-from rasterio import Affine
-from rasterio.transform import rowcol
 from tenacity import retry, stop_after_attempt
 
 from .. import setup, utils
 
 
+def terraclim_prefix(sampling='annual'):
+    """path of the terraclimate zarr store within the carbonplan-downscaling container"""
+    return f'obs/conus/4000m/{sampling}/terraclimate_plus_v3.zarr'
+
+
 @retry(stop=stop_after_attempt(5))
 def terraclim(
     store='az',
@@ -23,6 +24,9 @@ def terraclim(
     mask=None,
     group_repeats=False,
     remove_nans=False,
+    points=None,
+    gather='isel',
+    max_workers=None,
 ):
 
     with warnings.catch_warnings():
@@ -31,14 +35,14 @@ def terraclim(
         warnings.simplefilter('ignore', category=RuntimeWarning)
 
         path = setup.loading(store)
-        prefix = f'obs/conus/4000m/{sampling}/terraclimate_plus_v3.zarr'
+        prefix = terraclim_prefix(sampling)
 
         if store == 'az':
             mapper = zarr.storage.ABSStore(
                 'carbonplan-downscaling', prefix=prefix, account_name='carbonplan'
             )
         else:
-            mapper = fsspec.get_mapper((path / 'carbonplan-downscaling' / prefix).as_uri())
+            mapper = setup.get_mapper(path / 'carbonplan-downscaling' / prefix)
 
         ds = xr.open_zarr(mapper, consolidated=True)
 
@@ -66,61 +70,45 @@ def terraclim(
             X = X_coarse
 
         if df is not None:
-            t = Affine(*utils.albers_conus_transform(4000))
-            p1 = Proj(utils.albers_conus_crs())
-            p2 = Proj(proj='latlong', datum='WGS84')
-            x, y = transform(p2, p1, df['lon'].values, df['lat'].values)
-            rc = rowcol(t, x, y)
-            ind_r = xr.DataArray(rc[0], dims=['c'])
-            ind_c = xr.DataArray(rc[1], dims=['c'])
+            if points is None:
+                points = utils.PointIndex.from_df(df)
+            elif len(points) != len(df):
+                raise ValueError('points must index the same rows as df')
 
             if not group_repeats:
-                base = X[variables].isel(y=ind_r, x=ind_c).load()
+                base = points.gather(X[variables], method=gather, max_workers=max_workers)
                 for key in variables:
-                    df[key + '_mean'] = base[key].mean('time').values
-                    df[key + '_min'] = base[key].min('time').values
-                    df[key + '_max'] = base[key].max('time').values
+                    df[key + '_mean'] = points.expand(base[key].mean('time').values)
+                    df[key + '_min'] = points.expand(base[key].min('time').values)
+                    df[key + '_max'] = points.expand(base[key].max('time').values)
                 if remove_nans:
                     for key in variables:
                         df = df[~np.isnan(df[key + '_mean'])]
                 df = df.reset_index(drop=True)
                 return df
             else:
-                base = X[variables].isel(y=ind_r, x=ind_c).load()
-                for key in variables:
-                    array = base[key].values.T
-                    time = np.arange(X['time.year'].min(), X['time.year'].max() + 1)
-                    maxyear = max(
-                        map(
-                            lambda x: int(x.split('_')[1]),
-                            df.columns[['year' in c for c in df.columns]],
-                        )
+                base = points.gather(X[variables], method=gather, max_workers=max_workers)
+                time = np.arange(X['time.year'].min(), X['time.year'].max() + 1)
+                maxyear = max(
+                    map(
+                        lambda x: int(x.split('_')[1]),
+                        df.columns[['year' in c for c in df.columns]],
                     )
-                    pairs = [(str(y), str(y + 1)) for y in range(maxyear)]
+                )
+                pairs = [(str(y), str(y + 1)) for y in range(maxyear)]
+                windows = {
+                    pair: utils.window_offsets(
+                        time, df[f'year_{pair[0]}'].values, df[f'year_{pair[1]}'].values
+                    )
+                    for pair in pairs
+                }
+                for key in variables:
+                    array = points.expand(base[key].values.T, axis=0)
                     for pair in pairs:
-                        tlims = [
-                            (time > tmin) & (time <= tmax)
-                            if (~np.isnan(tmin) & ~np.isnan(tmax))
-                            else []
-                            for (tmin, tmax) in zip(df[f'year_{pair[0]}'], df[f'year_{pair[1]}'])
-                        ]
-
-                        def get_stats(a, t):
-                            if (len(t) > 0) and (t.sum() > 0):
-                                selection = a[t]
-                                return {
-                                    'min': selection.min(),
-                                    'max': selection.max(),
-                                    'mean': selection.mean(),
-                                }
-                            else:
-                                return {'min': np.NaN, 'max': np.NaN, 'mean': np.NaN}
-
-                        stats = [get_stats(a, t) for (a, t) in zip(array, tlims)]
-
-                        df[key + '_min_' + pair[1]] = [d['min'] for d in stats]
-                        df[key + '_max_' + pair[1]] = [d['max'] for d in stats]
-                        df[key + '_mean_' + pair[1]] = [d['mean'] for d in stats]
+                        stats = utils.window_stats(array, *windows[pair])
+                        df[key + '_min_' + pair[1]] = stats['min']
+                        df[key + '_max_' + pair[1]] = stats['max']
+                        df[key + '_mean_' + pair[1]] = stats['mean']
 
                 if remove_nans:
                     for key in variables:
@@ -51,20 +51,21 @@ def package_annualized(da, shape, signal='global', climate_prepend=None):
     """
     to get them into the right shapes for the model we need to do some ugly
     array reshaping
+
+    returns an array that broadcasts against shape (time, y, x) rather than a
+    dense copy: global trends are kept as a (time, 1, 1) vector and local
+    trends as a (time, y, x) array, with annual values repeated across months
     """
+    values = np.asarray(da)
+    if climate_prepend is None:
+        # annual values apply to each of the 12 months of their year
+        values = np.repeat(values, 12, axis=0)
+
     if signal == 'global':
-        if climate_prepend is not None:
-            tile_shape = [shape[1], shape[2]]
-        else:
-            tile_shape = [12, shape[1], shape[2]]
-        arr = np.asarray([np.tile(a, tile_shape) for a in da]).flatten()
+        arr = values.reshape(-1, 1, 1)
 
     if signal == 'local':
-        if climate_prepend is not None:
-            arr = da.values.flatten()
-        else:
-            tile_shape = [12, 1, 1]
-            arr = np.asarray([np.tile(a, tile_shape) for a in da]).flatten()
+        arr = values.reshape(-1, shape[1], shape[2])
 
     return arr
 
@@ -79,70 +80,68 @@ def fire(
     add_local_climate_trends=False,
     climate_prepend=None,
     analysis_tlim=('1970', '2099'),
+    dtype='float64',
+    return_inds=False,
 ):
     """
     Prepare x and y and group variables for fire model fitting
     given an xarray dataset
+
+    x is preallocated with the given dtype and each feature is written into its
+    column directly. With return_inds=True only rows where every feature is
+    finite are kept, and the flat (time, y, x) indices of those rows are
+    returned last so predictions can be scattered back with collect.fire.
     """
     shape = (len(climate.time), len(climate.y), len(climate.x))
-    x = np.asarray([climate[var].values.flatten() for var in climate.data_vars]).T
-    f = np.asarray([np.tile(a, [shape[0], 1, 1]).flatten() for a in nftd.values]).T
 
-    # after you've done your climate packaging you can tack on the earlier year for aggregations
+    # each feature is an array that broadcasts against (time, y, x)
+    features = [climate[var].values for var in climate.data_vars]
+    features += [a[np.newaxis] for a in nftd.values]
 
+    # after you've done your climate packaging you can tack on the earlier year for aggregations
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
-        if add_global_climate_trends is not None:
-            arr_list = []
-            for var, attrs in add_global_climate_trends.items():
-                arr_list.append(
-                    package_annualized(
-                        annualize(
-                            climate,
-                            var,
-                            'global',
-                            climate_prepend=attrs['climate_prepend'],
-                            rolling_period=attrs['rolling_period'],
-                            analysis_tlim=analysis_tlim,
-                        ),
-                        shape,
-                        'global',
+        for signal, trends in [
+            ('global', add_global_climate_trends),
+            ('local', add_local_climate_trends),
+        ]:
+            for var, attrs in (trends or {}).items():
+                arr = package_annualized(
+                    annualize(
+                        climate,
+                        var,
+                        signal,
                         climate_prepend=attrs['climate_prepend'],
-                    )
+                        rolling_period=attrs['rolling_period'],
+                        analysis_tlim=analysis_tlim,
+                    ),
+                    shape,
+                    signal,
+                    climate_prepend=attrs['climate_prepend'],
                 )
-            f2 = np.asarray(arr_list).T
-        if add_local_climate_trends is not None:
-            arr_list = []
-            for var, attrs in add_local_climate_trends.items():
-                arr_list.append(
-                    package_annualized(
-                        annualize(
-                            climate,
-                            var,
-                            'local',
-                            climate_prepend=attrs['climate_prepend'],
-                            rolling_period=attrs['rolling_period'],
-                            analysis_tlim=analysis_tlim,
-                        ),
-                        shape,
-                        'local',
-                        climate_prepend=attrs['climate_prepend'],
-                    )
-                )
-
-            f3 = np.asarray(arr_list).T
-    x = np.concatenate([x, f], axis=1)
-    if add_global_climate_trends:
-        x = np.concatenate([x, f2], axis=1)
-    if add_local_climate_trends:
-        x = np.concatenate([x, f3], axis=1)
+                features.append(arr)
+
+    if return_inds:
+        valid = np.ones(shape, dtype=bool)
+        for feature in features:
+            valid &= np.isfinite(feature)
+        inds = np.flatnonzero(valid)
+        rows = np.unravel_index(inds, shape)
+        del valid
+        x = np.empty((len(inds), len(features)), dtype=dtype)
+        for i, feature in enumerate(features):
+            x[:, i] = np.broadcast_to(feature, shape)[rows]
+    else:
+        x = np.empty((np.prod(shape), len(features)), dtype=dtype)
+        for i, feature in enumerate(features):
+            np.copyto(x[:, i].reshape(shape), feature, casting='unsafe')
 
     if eval_only:
-        return x
+        return (x, inds) if return_inds else x
 
     else:
         y = mtbs['monthly'].values.flatten()
-        return x, y
+        return (x, y[inds], inds) if return_inds else (x, y)
 
 
 def drought(df, eval_only=False, duration=10):
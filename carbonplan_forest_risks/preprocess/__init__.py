@@ -1,2 +1,2 @@
 # flake8: noqa
-from .fia import fia
+from .fia import fia, fia_batch
@@ -1,9 +1,52 @@
 # flake8: noqa
 import math
+import multiprocessing
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
 
-import networkx as nx
+import fsspec
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ..runner import read_manifest, write_manifest
+from ..setup.cache import fingerprint
+
+RAW_PATH = 'gs://carbonplan-data/raw/fia-states'
+OUT_PATH = 'gs://carbonplan-data/processed/fia-states/long'
+RAW_TABLES = ['tree', 'plot', 'cond']
+
+# tree table columns used by preprocess_state and their in-memory dtypes
+TREE_DTYPES = {
+    'PLT_CN': 'float64',
+    'CONDID': 'int32',
+    'STATUSCD': 'category',
+    'AGENTCD': 'category',
+    'DIA': 'float32',
+    'DIACALC': 'float32',
+    'HT': 'float32',
+    'ACTUALHT': 'float32',
+    'TPA_UNADJ': 'float32',
+    'TPAGROW_UNADJ': 'float32',
+    'TPAMORT_UNADJ': 'float32',
+    'CARBON_AG': 'float32',
+    'CARBON_BG': 'float32',
+}
+TREE_BATCH_SIZE = 1_000_000
+
+BULK_AGENT_MAP = {
+    1: 'frac_pop_mort_insect',
+    2: 'frac_pop_mort_disease',
+    3: 'frac_pop_mort_fire',
+    4: 'frac_pop_mort_animal',
+    5: 'frac_pop_mort_weather',
+    6: 'frac_pop_mort_vegetation',
+    7: 'frac_pop_mort_unknown',
+}
 
 
 def fia(states, save=True):
@@ -17,49 +60,220 @@ def fia(states, save=True):
         return [preprocess_state(state, save=save) for state in states]
 
 
+def fia_batch(
+    states='all',
+    raw_path=RAW_PATH,
+    out_path=OUT_PATH,
+    manifest_path=None,
+    max_workers=None,
+    force=False,
+):
+    """
+    Preprocess many states on a process pool, resuming from a manifest
+
+    Each state's parquet is written atomically and recorded in a json manifest
+    (default ``{out_path}/manifest.json``) together with fingerprints of its raw
+    tree/plot/cond inputs, wall time and peak memory. On re-run, states whose
+    inputs are unchanged and whose output still exists are skipped; failed
+    states are recorded with their traceback without discarding the others.
+    """
+    if states == 'all':
+        states = pd.read_csv('gs://carbonplan-data/raw/fia/REF_RESEARCH_STATION.csv')['STATE_ABBR']
+    if type(states) is str:
+        states = [states]
+    states = [state.lower() for state in states]
+    if manifest_path is None:
+        manifest_path = f'{out_path}/manifest.json'
+
+    manifest = read_manifest(manifest_path)
+    raw_fs, raw_root = fsspec.core.url_to_fs(raw_path)
+    out_fs = fsspec.core.url_to_fs(out_path)[0]
+
+    todo = []
+    for state in states:
+        try:
+            inputs = {
+                table: fingerprint(raw_fs.info(f'{raw_root}/{table}_{state}.parquet'))
+                for table in RAW_TABLES
+            }
+        except FileNotFoundError:
+            manifest[state] = {'state': state, 'status': 'failed', 'error': traceback.format_exc()}
+            write_manifest(manifest, manifest_path)
+            continue
+        record = manifest.get(state, {})
+        if (
+            not force
+            and record.get('status') == 'done'
+            and record.get('inputs') == inputs
+            and out_fs.exists(record['output'])
+        ):
+            continue
+        todo.append((state, inputs, raw_path, out_path))
+
+    if todo:
+        # one task per child so peak memory is measured per state
+        with multiprocessing.Pool(processes=max_workers, maxtasksperchild=1) as pool:
+            for record in pool.imap_unordered(_batch_state, todo):
+                manifest[record['state']] = record
+                write_manifest(manifest, manifest_path)
+
+    return manifest
+
+
+def _batch_state(args):
+    # resource is unix-only, so it is only imported where peak memory is recorded
+    import resource
+
+    state, inputs, raw_path, out_path = args
+    output = f'{out_path}/{state}.parquet'
+    start = time.perf_counter()
+    record = {'state': state, 'inputs': inputs, 'output': output}
+    try:
+        df = preprocess_state(state, save=False, raw_path=raw_path)
+        write_parquet_atomic(df, output)
+        record.update(status='done', rows=len(df))
+    except Exception:
+        record.update(status='failed', error=traceback.format_exc())
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    # ru_maxrss is reported in kilobytes on linux
+    record['peak_memory_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    record['completed'] = datetime.now(timezone.utc).isoformat()
+    return record
+
+
+def write_parquet_atomic(df, path):
+    """write to a temporary sibling first so readers never see a partial file"""
+    fs, path = fsspec.core.url_to_fs(path)
+    fs.makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with fs.open(tmp, 'wb') as f:
+        df.to_parquet(f, compression='gzip', engine='fastparquet')
+    fs.mv(tmp, path)
+
+
 def generate_uids(data, prev_cn_var='PREV_PLT_CN'):
     """
-    Generate dict mapping ever CN to a unique group, allows tracking single plot/tree through time
-    Can change `prev_cn_var` to apply to tree (etc)
+    Generate Series mapping ever CN to a unique group, allows tracking single plot/tree through time
+    Can change `prev_cn_var` to apply to tree (etc), e.g. `PREV_TRE_CN`
+
+    Each CN -> previous CN link is an edge; groups are the connected components, numbered
+    in order of first appearance so they match the previous networkx implementation.
+    """
+    cn = data['CN'].to_numpy()
+    prev = data[prev_cn_var].to_numpy()
+    has_prev = ~np.isnan(prev)
+
+    # interleave CN and previous CN in row order so factorized ids follow first appearance
+    width = 1 + has_prev
+    pos = np.cumsum(width) - width
+    nodes = np.empty(width.sum(), dtype=cn.dtype)
+    nodes[pos] = cn
+    nodes[pos[has_prev] + 1] = prev[has_prev]
+    ids, uniques = pd.factorize(nodes)
+    src = ids[pos[has_prev]]
+    dst = ids[pos[has_prev] + 1]
+
+    n = len(uniques)
+    graph = coo_matrix((np.ones(len(src)), (src, dst)), shape=(n, n))
+    n_components, labels = connected_components(graph, directed=False)
+
+    # renumber components by their earliest node
+    _, first = np.unique(labels, return_index=True)
+    order = np.empty(n_components, dtype='int64')
+    order[np.argsort(first)] = np.arange(n_components)
+    return pd.Series(order[labels], index=uniques)
+
+
+def read_tree_chunks(path, batch_size=TREE_BATCH_SIZE):
     """
-    g = nx.Graph()
-    for _, row in data[['CN', prev_cn_var]].iterrows():
-        if ~np.isnan(row[prev_cn_var]):  # has ancestor, add nodes + edge
-            g.add_edge(row.CN, row[prev_cn_var])
-        else:
-            g.add_node(row.CN)  # no ancestor, potentially not resampled
+    Stream the tree table in batches of at most batch_size rows with compact dtypes
+
+    Batches are cut within row groups, so memory stays bounded even when a state's
+    whole table was written as a single row group. Only the columns used for
+    condition-level statistics are decoded; codes become int32/categorical and
+    measurements float32.
+    """
+    with fsspec.open(path, 'rb') as f:
+        pf = pq.ParquetFile(f)
+        for batch in pf.iter_batches(batch_size=batch_size, columns=list(TREE_DTYPES)):
+            yield batch.to_pandas().astype(TREE_DTYPES, copy=False)
+
+
+def category_mask(values, test):
+    """evaluate test on the categories of a categorical column, then broadcast to rows"""
+    cats = values.cat.categories.to_numpy(dtype='float64')
+    lookup = np.append(test(cats), False)  # code -1 (missing) maps to the trailing False
+    return lookup[values.cat.codes.to_numpy()]
 
-    uids = {}
-    for uid, subgraph in enumerate(nx.connected_components(g)):
-        for node in subgraph:
-            uids[node] = uid
-    return uids
 
+def tree_condition_partials(tree):
+    """
+    Per-condition partial sums and counts for one chunk of the tree table
 
-def get_mort_removal_df(tree_df):
-    """Getting mortality requires a few extra steps -- we just generate a copy of the data here
-    and impute as needed!
+    Everything is a sum, so partials from different chunks combine by adding them.
+    The condition key is factorized first and each per-tree quantity is reduced
+    with bincount as soon as it is computed, so only a few tree-length arrays are
+    alive at once.
     """
-    mort_df = tree_df.copy()
-    mort_df = mort_df.reset_index(drop=True)
+    keys = pd.MultiIndex.from_arrays([tree['PLT_CN'], tree['CONDID']], names=['PLT_CN', 'CONDID'])
+    codes, conditions = keys.factorize()
+    n = len(conditions)
+    # trees without a condition key fall in a trailing bin that is dropped
+    codes[codes < 0] = n
+    sums = {}
+
+    def add(name, weights):
+        sums[name] = np.bincount(codes, weights=weights, minlength=n + 1)[:n]
+
+    # accumulate in float64 even though the chunk is stored as float32
+    dia = tree['DIA'].to_numpy(dtype='float64')
+    tpa = tree['TPA_UNADJ'].to_numpy(dtype='float64')
+    alive = category_mask(tree['STATUSCD'], lambda c: c == 1)
+    agent = tree['AGENTCD'].cat.categories.to_numpy(dtype='float64')
+    agent = np.append(agent, np.NaN)[tree['AGENTCD'].cat.codes.to_numpy()]
+
+    add('alive_n', alive)
+
+    # 892.179 converts lbs/acre to t/ha
+    for name, carbon in [('unadj_ag_biomass', 'CARBON_AG'), ('unadj_bg_biomass', 'CARBON_BG')]:
+        value = tree[carbon].to_numpy(dtype='float64') * tpa
+        value *= 2 / 892.1791216197013
+        value[~alive | np.isnan(value)] = 0
+        add(name, value)
+
+    value = (dia / (2 * 12)) ** 2
+    value *= math.pi
+    value *= tpa
+    value[~alive | np.isnan(value)] = 0
+    add('unadj_basal_area', value)
+
+    for var in ['HT', 'ACTUALHT']:
+        value = tree[var].to_numpy(dtype='float64')
+        counted = alive & ~np.isnan(value)
+        value[~counted] = 0
+        add(var, value)
+        add(var + '_n', counted)
+    del value, counted
 
     # 10 is minimum code - 0s are legacy and we assume anything < 10 is legacy as well.
-    mort_df = mort_df[(mort_df['AGENTCD'] >= 10) & (mort_df['AGENTCD'] < 90)]
+    mort = (agent >= 10) & (agent < 90)
 
     # fill in missing TPA_UNADJ with TPAGROW_UNADJ - this is totally off list but JS approved
-    mort_df.loc[np.isnan(mort_df['TPA_UNADJ']), 'TPA_UNADJ'] = mort_df['TPAGROW_UNADJ']
-    mort_df['unadj_basal_area'] = math.pi * (mort_df['DIA'] / (2 * 12)) ** 2 * mort_df['TPA_UNADJ']
+    tpa_mort = np.where(np.isnan(tpa), tree['TPAGROW_UNADJ'].to_numpy(dtype='float64'), tpa)
+    del tpa
 
     # drop trees where TPA_UNADJ == 0 -- we have no way of using these data
     # This is rare, but I interpret this to mean that tree cannot be reliably scaled to acre-1 measurement -- for whatever reason
-    mort_df = mort_df[mort_df['TPA_UNADJ'] > 0]
+    mort &= tpa_mort > 0
 
     # smaller-ish trees with agent code somtimes lack a DIA, but have a DIACALC -- back-fill. JS approved!
-    mort_df.loc[np.isnan(mort_df['DIA']), 'unadj_basal_area'] = (
-        math.pi
-        * (mort_df[np.isnan(mort_df['DIA'])]['DIACALC'] / (2 * 12)) ** 2
-        * mort_df[np.isnan(mort_df['DIA'])]['TPA_UNADJ']
-    )
+    mort_basal_area = np.where(np.isnan(dia), tree['DIACALC'].to_numpy(dtype='float64'), dia)
+    del dia
+    mort_basal_area /= 2 * 12
+    mort_basal_area **= 2
+    mort_basal_area *= math.pi
+    mort_basal_area *= tpa_mort
+    del tpa_mort
 
     # TODO: There is another pot of trees we can access if we impute old diameters
     # if a tree is dead (['STATUSCD'] == 2)
@@ -68,46 +282,82 @@ def get_mort_removal_df(tree_df):
     # The current record either has a TPA_UNADJ or TPAGROW_UNADJ ((tree_df['TPA_UNADJ'] > 0 ) | (tree_df['TPAGROW_UNADJ'] > 0))
     # These would allow recovery a handful of conditions, primarily in region 8 (i think)
 
-    # do not return records without unadj_basal_area -- see above TODO.
-    return mort_df[mort_df['unadj_basal_area'] > 0]
+    # do not use records without unadj_basal_area -- see above TODO.
+    mort &= mort_basal_area > 0
 
+    # define queries -- we then aggregate each separately (with counts) to prevent zeros from sneaking in
+    pop_mort = mort & (tree['TPAMORT_UNADJ'].to_numpy() > 0) & (agent >= 10) & (agent < 80)
 
-def preprocess_state(state_abbr, save=True):
-    state_abbr = state_abbr.lower()
-    tree_df = pd.read_parquet(
-        f'gs://carbonplan-data/raw/fia-states/tree_{state_abbr}.parquet',
-        columns=[
-            'CN',
-            'PLT_CN',
-            'DIA',
-            'DIACALC',
-            'HT',
-            'ACTUALHT',
-            'STATUSCD',
-            'CONDID',
-            'TPA_UNADJ',
-            'AGENTCD',
-            'TPAGROW_UNADJ',
-            'TPAMORT_UNADJ',
-            'TPAREMV_UNADJ',
-            'DIACHECK',
-            'CARBON_AG',
-            'CARBON_BG',
-        ],
-    )
-    # calculate tree-level statistics that will sum later.
-    tree_df['unadj_basal_area'] = math.pi * (tree_df['DIA'] / (2 * 12)) ** 2 * tree_df['TPA_UNADJ']
+    def add_query(name, idx):
+        add(name, np.where(idx, mort_basal_area, 0))
+        add(name + '_n', idx)
 
-    # 892.179 converts lbs/acre to t/ha
-    tree_df['unadj_ag_biomass'] = (
-        tree_df['CARBON_AG'] * tree_df['TPA_UNADJ'] * 2 / 892.1791216197013
+    add_query('unadj_full_mort', mort & (agent < 80))
+    add_query('unadj_pop_mort', pop_mort)
+    add_query('unadj_removal', mort & (agent == 80))  # & (TPAREMV_UNADJ > 0)
+
+    # rerun aggregation with AGENTCD to get fraction mortality on pop estimates
+    for code in BULK_AGENT_MAP:
+        add_query(f'agent_{code}', pop_mort & (agent // 10 == code))
+
+    return pd.DataFrame(sums, index=pd.MultiIndex.from_tuples(conditions, names=keys.names))
+
+
+def condition_tree_stats(partials):
+    """
+    Combine per-chunk partials into one frame of condition-level statistics
+
+    Alive sums and means are only defined for conditions with live trees, mortality
+    and removal sums for conditions with matching trees, and the fraction of
+    population mortality by agent for conditions with population mortality.
+    """
+    if len(partials) == 1:
+        stats = partials[0]
+    else:
+        stats = pd.concat(partials).groupby(level=['PLT_CN', 'CONDID']).sum()
+
+    out = pd.DataFrame(index=stats.index)
+
+    # per-tree variables that sum per condition
+    alive = stats['alive_n'] > 0
+    for var in ['unadj_ag_biomass', 'unadj_bg_biomass', 'unadj_basal_area']:
+        out[var] = stats[var].where(alive)
+
+    for var in ['HT', 'ACTUALHT']:
+        out[var] = (stats[var] / stats[var + '_n']).where(alive)
+
+    for var in ['unadj_full_mort', 'unadj_pop_mort', 'unadj_removal']:
+        out[var] = stats[var].where(stats[var + '_n'] > 0)
+
+    # agents to col, then convert to fraction
+    present = [code for code in BULK_AGENT_MAP if stats[f'agent_{code}_n'].sum() > 0]
+    pop_mort_by_agent = stats[[f'agent_{code}' for code in present]].where(
+        stats[[f'agent_{code}_n' for code in present]].to_numpy() > 0
     )
-    tree_df['unadj_bg_biomass'] = (
-        tree_df['CARBON_BG'] * tree_df['TPA_UNADJ'] * 2 / 892.1791216197013
+    fraction_pop_mort = (
+        pop_mort_by_agent.div(
+            pop_mort_by_agent.sum(axis=1), axis=0
+        )  # invokes numpy broadcasting along each row.
+        .fillna(0)
+        .round(3)
+        .where(stats['unadj_pop_mort_n'] > 0, axis=0)
     )
+    for code in present:
+        out[BULK_AGENT_MAP[code]] = fraction_pop_mort[f'agent_{code}']
+
+    return out
+
+
+def preprocess_state(state_abbr, save=True, raw_path=RAW_PATH, out_path=OUT_PATH):
+    state_abbr = state_abbr.lower()
+    # stream the tree table so peak memory scales with conditions rather than trees
+    partials = [
+        tree_condition_partials(tree)
+        for tree in read_tree_chunks(f'{raw_path}/tree_{state_abbr}.parquet')
+    ]
 
-    plot_df = pd.read_parquet(f'gs://carbonplan-data/raw/fia-states/plot_{state_abbr}.parquet')
-    cond_df = pd.read_parquet(f'gs://carbonplan-data/raw/fia-states/cond_{state_abbr}.parquet')
+    plot_df = pd.read_parquet(f'{raw_path}/plot_{state_abbr}.parquet')
+    cond_df = pd.read_parquet(f'{raw_path}/cond_{state_abbr}.parquet')
 
     cond_vars = [
         'STDAGE',
@@ -199,76 +449,17 @@ def preprocess_state(state_abbr, save=True):
         (pd.concat(trt_hot_encodings, axis=1)).groupby(level=0, axis=1).sum().astype(bool)
     )
 
-    # per-tree variables that need to sum per condition
-    alive_sum_vars = ['unadj_ag_biomass', 'unadj_bg_biomass', 'unadj_basal_area']
-    condition_alive_sums = (
-        tree_df.loc[tree_df['STATUSCD'] == 1].groupby(['PLT_CN', 'CONDID'])[alive_sum_vars].sum()
-    )
-
-    alive_mean_vars = ['HT', 'ACTUALHT']
-    condition_alive_means = (
-        tree_df.loc[tree_df['STATUSCD'] == 1].groupby(['PLT_CN', 'CONDID'])[alive_mean_vars].mean()
-    )
-
-    mort_removal_trees = get_mort_removal_df(tree_df)
-
-    # define queries -- we then subset mort_removal_trees and aggregate separately to prevent zeros from sneaking in
-    mort_removal_queries = {
-        'unadj_full_mort': (mort_removal_trees['AGENTCD'] < 80),
-        'unadj_pop_mort': (mort_removal_trees['TPAMORT_UNADJ'] > 0)
-        & (mort_removal_trees['AGENTCD'] >= 10)
-        & (mort_removal_trees['AGENTCD'] < 80),
-        'unadj_removal': (mort_removal_trees['AGENTCD'] == 80)
-        # & (mort_removal_trees['TPAREMV_UNADJ'] > 0),
-    }
-
-    condition_mort_removal = pd.concat(
+    condition_stats = condition_tree_stats(partials)
+    # live tree stats come before the disturbance flags and mortality after, as they always have
+    live = ['unadj_ag_biomass', 'unadj_bg_biomass', 'unadj_basal_area', 'HT', 'ACTUALHT']
+    full = cond_agg.join(
         [
-            mort_removal_trees[idx]
-            .groupby(['PLT_CN', 'CONDID'])['unadj_basal_area']
-            .sum()
-            .rename(k)
-            for k, idx in mort_removal_queries.items()
-        ],
-        axis=1,
-    )
-
-    # rerun aggregation with AGENTCD to get fraction mortality on pop estimates
-    pop_mort_trees = mort_removal_trees[mort_removal_queries['unadj_pop_mort']]
-    pop_mort_by_agent = (
-        pop_mort_trees.groupby(['PLT_CN', 'CONDID', pop_mort_trees['AGENTCD'] // 10])[
-            'unadj_basal_area'
+            condition_stats[live],
+            disturb_flags,
+            treatment_flags,
+            condition_stats.drop(columns=live),
         ]
-        .sum()
-        .unstack(2)  # agents to col
     )
-
-    BULK_AGENT_MAP = {
-        1: 'frac_pop_mort_insect',
-        2: 'frac_pop_mort_disease',
-        3: 'frac_pop_mort_fire',
-        4: 'frac_pop_mort_animal',
-        5: 'frac_pop_mort_weather',
-        6: 'frac_pop_mort_vegetation',
-        7: 'frac_pop_mort_unknown',
-    }
-
-    # convert to fraction
-    fraction_pop_mort = (
-        pop_mort_by_agent.div(
-            pop_mort_by_agent.sum(axis=1), axis=0
-        )  # invokes numpy broadcasting along each row.
-        .fillna(0)
-        .round(3)
-        .rename(columns=BULK_AGENT_MAP)
-    )
-
-    full = cond_agg.join(condition_alive_sums)
-    full = full.join(condition_alive_means)
-    full = full.join(disturb_flags)
-    full = full.join(treatment_flags)
-    full = full.join(condition_mort_removal)
-    full = full.join(fraction_pop_mort)
     full = full.reset_index()
 
     full.loc[:, 'adj_full_mort'] = full.unadj_full_mort / full.CONDPROP_UNADJ
@@ -288,7 +479,7 @@ def preprocess_state(state_abbr, save=True):
 
     if save:
         full.to_parquet(
-            f'gs://carbonplan-data/processed/fia-states/long/{state_abbr}.parquet',
+            f'{out_path}/{state_abbr}.parquet',
             compression='gzip',
             engine='fastparquet',
         )
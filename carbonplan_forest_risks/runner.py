@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import dask.array as dsa
+import fsspec
+import pandas as pd
+import xarray as xr
+
+from . import setup
+from .setup.cache import fingerprint
+
+DEFAULT_CHECKPOINT_DIR = os.path.join('data', 'checkpoints')
+
+
+def _run_task(func, task, retries):
+    start = time.perf_counter()
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            func(task)
+            error = None
+            break
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+    return {
+        'status': 'failed' if error else 'done',
+        'attempts': attempt,
+        'seconds': time.perf_counter() - start,
+        'error': error,
+    }
+
+
+def run_tasks(func, tasks, max_workers=None, processes=False, retries=1):
+    """
+    Run func(task) for every task on a thread pool (or a process pool with processes=True)
+
+    Tasks must be independent, e.g. each writing its own zarr region, so they can
+    run and finish in any order. A failing task is retried up to retries times and
+    then reported without affecting the others. Returns a report with one row per
+    task: status ('done' or 'failed'), attempts, seconds and the last error.
+    """
+    tasks = list(tasks)
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_run_task, func, task, retries) for task in tasks]
+        reports = [future.result() for future in futures]
+    return pd.DataFrame(reports, index=pd.Index(tasks))
+
+
+def zarr_template(store, name, dims, coords, chunks, dtype='float32'):
+    """
+    Create an empty zarr store holding one variable, to be filled with write_region
+
+    coords gives the coordinate values for each dimension plus any static
+    coordinates such as lat/lon, which are written now. chunks maps each
+    dimension to a chunk size; chunks should line up with the regions tasks
+    write so that concurrent writes never share a chunk.
+    """
+    shape = tuple(len(coords[dim]) for dim in dims)
+    data = dsa.empty(shape, chunks=tuple(chunks[dim] for dim in dims), dtype=dtype)
+    ds = xr.Dataset({name: (dims, data)}, coords=coords)
+    encoding = {dim: {'chunks': (chunks[dim],)} for dim in dims if dim in ds.coords}
+    ds.to_zarr(store, mode='w', compute=False, encoding=encoding)
+
+
+def write_region(store, name, values, dims, region):
+    """write values into the region (a dict of dim -> slice) of a store from zarr_template"""
+    xr.Dataset({name: (dims, values)}).to_zarr(store, region=region)
+
+
+def read_manifest(path):
+    """read a json manifest, or an empty one if path does not exist yet"""
+    fs, path = fsspec.core.url_to_fs(path)
+    if not fs.exists(path):
+        return {}
+    with fs.open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, path):
+    """write a json manifest through a temporary sibling so readers never see a partial file"""
+    fs, path = fsspec.core.url_to_fs(path)
+    fs.makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with fs.open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    fs.mv(tmp, path)
+
+
+def store_inputs(store, paths):
+    """
+    urls of paths within a data store, to fingerprint as RunState inputs
+
+    zarr stores are fingerprinted through their consolidated .zmetadata, which
+    is rewritten whenever the store is.
+    """
+    urls = []
+    for path in paths:
+        if path.rstrip('/').endswith('.zarr'):
+            path = f"{path.rstrip('/')}/.zmetadata"
+        urls.append(setup.store_url(store, path))
+    return urls
+
+
+def run_key(params, inputs=None):
+    """
+    hash run parameters together with the package version and fingerprints of
+    any input files or stores
+    """
+    from . import __version__
+
+    fingerprints = {}
+    for url in inputs or []:
+        fs, path = fsspec.core.url_to_fs(str(url))
+        fingerprints[str(url)] = fingerprint(fs.info(path))
+    blob = {'params': params, 'inputs': fingerprints, 'version': __version__}
+    blob = json.dumps(blob, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+
+class RunState:
+    """
+    Checkpoint for a long projection run
+
+    State lives under {root}/{name}-{key}, where key hashes the run parameters,
+    the package version and the fingerprints of the inputs, so changing any of
+    them starts a fresh run. params should hold every setting that shapes the
+    results, including fitting options, or a restarted run will reuse stale ones.
+    Results of finished units, e.g. the model fit or a (gcm, scenario, target)
+    output, are pickled next to a manifest.json listing the completed units,
+    and a restarted run skips straight to the units that are still pending.
+    root can be a local path or any fsspec url and defaults to the
+    FOREST_RISKS_CHECKPOINT_DIR environment variable, or data/checkpoints.
+
+    Marking units done is safe across threads but not across processes.
+    """
+
+    def __init__(self, name, params, inputs=None, root=None):
+        if root is None:
+            root = os.environ.get('FOREST_RISKS_CHECKPOINT_DIR', DEFAULT_CHECKPOINT_DIR)
+        self.key = run_key(params, inputs)
+        self.path = f"{str(root).rstrip('/')}/{name}-{self.key}"
+        self._lock = threading.Lock()
+        self.manifest = read_manifest(self.manifest_path) or {
+            'params': json.loads(json.dumps(params, default=str)),
+            'units': {},
+        }
+
+    def __repr__(self):
+        return f"RunState(path='{self.path}', done={len(self.manifest['units'])})"
+
+    @property
+    def manifest_path(self):
+        return f'{self.path}/manifest.json'
+
+    @staticmethod
+    def unit_key(unit):
+        if isinstance(unit, (tuple, list)):
+            return '/'.join(map(str, unit))
+        return str(unit)
+
+    def is_done(self, unit):
+        return self.unit_key(unit) in self.manifest['units']
+
+    def pending(self, units):
+        return [unit for unit in units if not self.is_done(unit)]
+
+    def mark_done(self, unit):
+        with self._lock:
+            completed = datetime.now(timezone.utc).isoformat()
+            self.manifest['units'][self.unit_key(unit)] = {'completed': completed}
+            write_manifest(self.manifest, self.manifest_path)
+
+    def save(self, unit, obj):
+        path = f'{self.path}/{self.unit_key(unit)}.pkl'
+        fs, path = fsspec.core.url_to_fs(path)
+        fs.makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with fs.open(tmp, 'wb') as f:
+            pickle.dump(obj, f)
+        fs.mv(tmp, path)
+
+    def load(self, unit):
+        with fsspec.open(f'{self.path}/{self.unit_key(unit)}.pkl', 'rb') as f:
+            return pickle.load(f)
+
+    def compute(self, unit, func):
+        """return the saved result of unit if it is done, otherwise run func and save it"""
+        if self.is_done(unit):
+            return self.load(unit)
+        result = func()
+        self.save(unit, result)
+        self.mark_done(unit)
+        return result
@@ -1,3 +1,3 @@
 # flake8: noqa
-from .loading import loading
+from .loading import get_mapper, layer_cache, loading, store_url
 from .plotting import plotting
@@ -0,0 +1,361 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from urllib.parse import urlparse
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / '.cache' / 'carbonplan-forest-risks'
+DEFAULT_MAX_SIZE = 50 * 2**30
+DEFAULT_TTL = 3600
+DEFAULT_LAYER_ENTRIES = 8
+
+FINGERPRINT_KEYS = ['ETag', 'etag', 'md5', 'size', 'mtime', 'last_modified', 'LastModified']
+
+
+def fingerprint(info):
+    """summarize an fsspec info dict into a string that changes when the content does"""
+    return '|'.join(str(info.get(k)) for k in FINGERPRINT_KEYS if info.get(k) is not None)
+
+
+class ReadThroughCache:
+    """
+    Local on-disk cache for files read from a remote store
+
+    Entries are keyed by the remote url. Each entry records the remote
+    fingerprint (etag, size and modification time when available) and when it
+    was last checked; a cached entry is served without contacting the remote
+    until it is older than ttl seconds, and is then revalidated, so a changed
+    remote file is fetched again. Total size is bounded by max_size, evicting
+    the least recently used entries first.
+    """
+
+    def __init__(self, directory=None, max_size=None, ttl=None):
+        if directory is None:
+            directory = os.environ.get('FOREST_RISKS_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_size is None:
+            max_size = int(os.environ.get('FOREST_RISKS_CACHE_SIZE', DEFAULT_MAX_SIZE))
+        if ttl is None:
+            ttl = float(os.environ.get('FOREST_RISKS_CACHE_TTL', DEFAULT_TTL))
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = None
+
+    def __repr__(self):
+        return (
+            f"ReadThroughCache(directory='{self.directory}', max_size={self.max_size}, "
+            f'ttl={self.ttl})'
+        )
+
+    def key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def local_path(self, url):
+        key = self.key(url)
+        suffix = pathlib.PurePosixPath(urlparse(url).path).suffix
+        return key, self.directory / key[:2] / (key + suffix)
+
+    def fetch(self, url):
+        """return a local path holding the contents of url, downloading it if needed"""
+        key, local = self.local_path(url)
+        meta = local.parent / f'{key}.meta'
+
+        record = self._cached_record(key, local)
+        if record is not None and time.time() - record['checked'] < self.ttl:
+            os.utime(local)
+            return str(local)
+
+        fs, remote = fsspec.core.url_to_fs(url)
+        info = fs.info(remote)
+        if info.get('type') == 'directory':
+            raise IsADirectoryError(url)
+        if record is not None and record['fingerprint'] == fingerprint(info):
+            _write_meta(meta, record['fingerprint'])
+            os.utime(local)
+            return str(local)
+
+        local.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=local.parent, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as dst, fs.open(remote, 'rb') as src:
+                while True:
+                    block = src.read(2**22)
+                    if not block:
+                        break
+                    dst.write(block)
+            os.replace(tmp, local)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        _write_meta(meta, fingerprint(info))
+
+        with self._lock:
+            self._index[key] = (local, local.stat().st_size)
+            self._evict(keep=key)
+        return str(local)
+
+    def exists(self, url):
+        """whether url is a file, answered from the cache when it holds a fresh copy"""
+        key, local = self.local_path(url)
+        record = self._cached_record(key, local)
+        if record is not None and time.time() - record['checked'] < self.ttl:
+            return True
+        fs, remote = fsspec.core.url_to_fs(url)
+        return fs.isfile(remote)
+
+    def _cached_record(self, key, local):
+        """fingerprint and check time of a cached entry, marking it as recently used"""
+        with self._lock:
+            self._load_index()
+            if key not in self._index or not local.exists():
+                return None
+            self._index[key] = self._index.pop(key)
+        return _read_meta(local.parent / f'{key}.meta')
+
+    def size(self):
+        with self._lock:
+            self._load_index()
+            return sum(size for _, size in self._index.values())
+
+    def clear(self):
+        with self._lock:
+            self._load_index()
+            for key, (local, _) in self._index.items():
+                local.unlink(missing_ok=True)
+                (local.parent / f'{key}.meta').unlink(missing_ok=True)
+            self._index = {}
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        if self.directory.exists():
+            for local in self.directory.glob('??/*'):
+                if local.suffix in ('.part', '.meta') or not local.is_file():
+                    continue
+                stat = local.stat()
+                entries.append((stat.st_atime_ns, local.name.split('.')[0], local, stat.st_size))
+        # keep the index in least-recently-used order
+        self._index = {key: (local, size) for _, key, local, size in sorted(entries)}
+
+    def _evict(self, keep=None):
+        total = sum(size for _, size in self._index.values())
+        for key in list(self._index):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            local, size = self._index.pop(key)
+            local.unlink(missing_ok=True)
+            (local.parent / f'{key}.meta').unlink(missing_ok=True)
+            total -= size
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(path, fingerprint):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+    with open(tmp, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'checked': time.time()}, f)
+    os.replace(tmp, path)
+
+
+def url_join(base, path=''):
+    """join path onto a store root or url, giving a string fsspec can open"""
+    base = str(base)
+    if base.endswith(':'):
+        # urlpath renders bucket roots such as 'gs://' as 'gs:'
+        base += '//'
+    path = str(path).strip('/')
+    if not path:
+        return base
+    sep = '' if base.endswith('/') else '/'
+    return base + sep + path
+
+
+class CachedPath(os.PathLike):
+    """
+    Remote path whose file reads go through a ReadThroughCache
+
+    Supports the same ``/``, ``as_uri()`` and ``os.fspath`` usage as the
+    paths returned by ``setup.loading`` for the other stores.
+    """
+
+    def __init__(self, base, cache):
+        self.base = url_join(base)
+        self.cache = cache
+
+    def __truediv__(self, other):
+        return CachedPath(url_join(self.base, other), self.cache)
+
+    def __str__(self):
+        return self.base
+
+    def __repr__(self):
+        return f"CachedPath('{self.base}')"
+
+    def __fspath__(self):
+        return self.cache.fetch(self.base)
+
+    def as_uri(self):
+        return pathlib.Path(self.cache.fetch(self.base)).as_uri()
+
+    def get_mapper(self):
+        return CachedMapper(self)
+
+
+class CachedMapper(MutableMapping):
+    """
+    Read-only key/value view of a cached directory, e.g. a zarr store
+
+    Implements MutableMapping only so zarr accepts it as a store; writes raise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __getitem__(self, key):
+        try:
+            local = (self.path / key).__fspath__()
+        except (FileNotFoundError, IsADirectoryError):
+            raise KeyError(key)
+        with open(local, 'rb') as f:
+            return f.read()
+
+    def __setitem__(self, key, value):
+        raise PermissionError('cached stores are read-only')
+
+    def __delitem__(self, key):
+        raise PermissionError('cached stores are read-only')
+
+    def __contains__(self, key):
+        path = self.path / key
+        return path.cache.exists(path.base)
+
+    def __iter__(self):
+        return iter(fsspec.get_mapper(self.path.base))
+
+    def __len__(self):
+        return len(fsspec.get_mapper(self.path.base))
+
+
+def mask_hash(mask):
+    """
+    hash the values of a mask, treating 0 and NaN alike
+
+    The loaders set zeros in the masks they are given to NaN, so a mask that has
+    already been through one loader call hashes the same as before.
+    """
+    if mask is None:
+        return None
+    vals = np.asarray(mask, dtype='float64')
+    vals = np.where(vals == 0, np.NaN, vals)
+    return hashlib.sha256(str(vals.shape).encode() + vals.tobytes()).hexdigest()
+
+
+class LayerCache:
+    """
+    Two-level cache for processed static layers such as the NLCD and NFTD stacks
+
+    Each layer is keyed by the loader name, its parameters (store, year, classes,
+    coarsen, ...) and a hash of the mask. Built layers are written once to a
+    chunked zarr store under directory, keyed also by the fingerprints of the
+    source files so a reprocessed source is picked up, and the most recently used
+    max_entries are kept in memory, so repeat calls skip decoding the source
+    GeoTIFFs. Sources are fingerprinted only on a memory miss, as a process is
+    assumed not to outlive a change to its inputs. Calls get a copy, so callers
+    can modify what they get back.
+    """
+
+    def __init__(self, directory=None, max_entries=None):
+        if directory is None:
+            directory = os.environ.get(
+                'FOREST_RISKS_LAYER_CACHE_DIR',
+                pathlib.Path(os.environ.get('FOREST_RISKS_CACHE_DIR', DEFAULT_CACHE_DIR))
+                / 'layers',
+            )
+        if max_entries is None:
+            max_entries = int(os.environ.get('FOREST_RISKS_LAYER_ENTRIES', DEFAULT_LAYER_ENTRIES))
+        self.directory = pathlib.Path(directory)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+
+    def __repr__(self):
+        return f"LayerCache(directory='{self.directory}', max_entries={self.max_entries})"
+
+    def key(self, name, params, mask=None, sources=None):
+        fingerprints = {}
+        for url in sources or []:
+            fs, path = fsspec.core.url_to_fs(str(url))
+            fingerprints[str(url)] = fingerprint(fs.info(path))
+        blob = json.dumps(
+            {'params': params, 'mask': mask_hash(mask), 'sources': fingerprints},
+            sort_keys=True,
+            default=str,
+        )
+        return f'{name}-' + hashlib.sha256(blob.encode()).hexdigest()[:24]
+
+    def get(self, name, params, build, mask=None, sources=None):
+        """
+        return the layer for name, params and mask, calling build() to make it if needed
+
+        sources lists the urls of the files build() reads
+        """
+        key = self.key(name, params, mask=mask)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key].copy(deep=True)
+
+        local = self.directory / f'{self.key(name, params, mask=mask, sources=sources)}.zarr'
+        if local.exists():
+            layer = xr.open_zarr(local)['layer'].load()
+            layer.encoding = {}
+        else:
+            layer = build()
+            self._write(layer, local)
+        layer.name = None
+
+        with self._lock:
+            self._memory[key] = layer
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+        return layer.copy(deep=True)
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+        if disk and self.directory.exists():
+            shutil.rmtree(self.directory)
+
+    def _write(self, layer, local):
+        local.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=local.parent, suffix='.part')
+        chunks = {dim: 1 if dim == 'band' else size for dim, size in layer.sizes.items()}
+        try:
+            layer.chunk(chunks).to_dataset(name='layer').to_zarr(tmp, mode='w')
+            os.replace(tmp, local)
+        except OSError:
+            # another process finished the same layer first
+            if not local.exists():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
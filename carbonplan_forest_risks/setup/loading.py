@@ -1,11 +1,23 @@
 import pathlib
 
+import fsspec
 import urlpath
 
+from .cache import CachedPath, LayerCache, ReadThroughCache, url_join
 
-def loading(store=None):
+_caches = {}
+_layer_cache = None
+
+
+def loading(store=None, cache_dir=None, cache_size=None):
     if store is None:
         raise ValueError('data store not specified')
+    if store.endswith('-cached'):
+        # e.g. 'az-cached' reads through a local on-disk cache of the 'az' store
+        key = (cache_dir, cache_size)
+        if key not in _caches:
+            _caches[key] = ReadThroughCache(directory=cache_dir, max_size=cache_size)
+        return CachedPath(loading(store[: -len('-cached')]), _caches[key])
     if store == 'gs':
         base = urlpath.URL('gs://')
     elif store == 'az':
@@ -14,3 +26,22 @@ def loading(store=None):
         base = pathlib.Path(pathlib.Path.home() / 'workdir')
 
     return base
+
+
+def store_url(store, path):
+    """url of a path within store as a string fsspec can open, e.g. to fingerprint it"""
+    return url_join(loading(store), path)
+
+
+def get_mapper(path):
+    if isinstance(path, CachedPath):
+        return path.get_mapper()
+    return fsspec.get_mapper(path.as_uri())
+
+
+def layer_cache():
+    """return the shared LayerCache used by the static layer loaders"""
+    global _layer_cache
+    if _layer_cache is None:
+        _layer_cache = LayerCache()
+    return _layer_cache
@@ -1,6 +1,8 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import xarray as xr
 import zarr
 from pyproj import Proj, transform
 from rasterio import Affine
@@ -89,6 +91,99 @@ def latlon_to_xy(lat, lon, base_crs=albers_conus_crs()):
     return x, y
 
 
+class PointIndex:
+    """
+    Grid cell lookup for a fixed set of lat/lon points
+
+    Points are projected once, duplicate cells are collapsed, and ``inverse``
+    maps each point back to its unique cell, so the same index can be reused
+    across many loader calls on the same frame.
+    """
+
+    def __init__(self, lat, lon, res=4000):
+        x, y = latlon_to_xy(lat, lon)
+        r, c = rowcol(Affine(*albers_conus_transform(res)), x, y)
+        cells = np.stack([np.asarray(r), np.asarray(c)], axis=1)
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        self.res = res
+        self.rows = unique[:, 0]
+        self.cols = unique[:, 1]
+        self.inverse = inverse.reshape(-1)
+
+    @classmethod
+    def from_df(cls, df, res=4000):
+        return cls(df['lat'].values, df['lon'].values, res=res)
+
+    def __len__(self):
+        return len(self.inverse)
+
+    def __repr__(self):
+        return f'PointIndex(points={len(self)}, cells={len(self.rows)}, res={self.res})'
+
+    def gather(self, ds, method='isel', max_workers=None):
+        """
+        select the unique cells from ds along a new 'c' dimension
+
+        method='isel' uses a single vectorized index, method='chunks' reads only
+        the chunks that contain points (optionally on a thread pool) and
+        scatters them into a compact (..., c) array. Both raise a ValueError if any
+        point falls outside the grid of ds.
+        """
+        ny, nx = ds.sizes['y'], ds.sizes['x']
+        outside = (self.rows < 0) | (self.rows >= ny) | (self.cols < 0) | (self.cols >= nx)
+        if outside.any():
+            raise ValueError(
+                f'{outside.sum()} of {len(self.rows)} grid cells fall outside the '
+                f'{ny} x {nx} grid, e.g. row {self.rows[outside][0]}, col {self.cols[outside][0]}'
+            )
+        if method == 'chunks':
+            return self._gather_chunks(ds, max_workers=max_workers)
+        if method != 'isel':
+            raise ValueError(f"gather method='{method}' not implemented")
+        ind_r = xr.DataArray(self.rows, dims=['c'])
+        ind_c = xr.DataArray(self.cols, dims=['c'])
+        return ds.isel(y=ind_r, x=ind_c).load()
+
+    def _gather_chunks(self, ds, max_workers=None):
+        out = xr.Dataset()
+        for key in ds.data_vars:
+            da = ds[key].transpose(..., 'y', 'x')
+            if da.chunks is None:
+                ybounds = np.array([0, da.sizes['y']])
+                xbounds = np.array([0, da.sizes['x']])
+            else:
+                ybounds = np.cumsum([0] + list(da.chunksizes['y']))
+                xbounds = np.cumsum([0] + list(da.chunksizes['x']))
+            cy = np.searchsorted(ybounds, self.rows, side='right') - 1
+            cx = np.searchsorted(xbounds, self.cols, side='right') - 1
+            block = cy * (len(xbounds) - 1) + cx
+            order = np.argsort(block, kind='stable')
+            blocks, starts = np.unique(block[order], return_index=True)
+            groups = np.split(order, starts[1:])
+
+            def read(group):
+                iy, ix = cy[group[0]], cx[group[0]]
+                y0, y1 = ybounds[iy], ybounds[iy + 1]
+                x0, x1 = xbounds[ix], xbounds[ix + 1]
+                sub = da.isel(y=slice(y0, y1), x=slice(x0, x1)).load(scheduler='synchronous')
+                return sub.values[..., self.rows[group] - y0, self.cols[group] - x0]
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(read, groups))
+
+            values = np.empty(da.shape[:-2] + (len(self.rows),), dtype=da.dtype)
+            for group, result in zip(groups, results):
+                values[..., group] = result
+            dims = da.dims[:-2] + ('c',)
+            coords = {k: v for k, v in da.coords.items() if set(v.dims) <= set(dims)}
+            out[key] = xr.DataArray(values, dims=dims, coords=coords)
+        return out
+
+    def expand(self, values, axis=-1):
+        """map per-cell values back onto the original points"""
+        return np.take(values, self.inverse, axis=axis)
+
+
 def zscore_2d(x, mean=None, std=None):
     recomputing = False
     if mean is None or std is None:
@@ -108,18 +203,93 @@ def zscore_2d(x, mean=None, std=None):
 
 
 def remove_nans(x, y=None, return_inds=False):
+    """
+    drop rows of x (and y) with missing values
+
+    When every row is complete the inputs are returned as they are rather than copied.
+    """
     if y is None:
         inds = np.isnan(x).sum(axis=1) == 0
+        if not inds.all():
+            x = x[inds]
         if return_inds:
-            return x[inds], inds
+            return x, inds
         else:
-            return x[inds]
+            return x
     else:
         inds = (np.isnan(x).sum(axis=1) == 0) & (~np.isnan(y)) & (~np.isinf(y))
+        if not inds.all():
+            x, y = x[inds], y[inds]
         if return_inds:
-            return x[inds], y[inds], inds
+            return x, y, inds
         else:
-            return x[inds], y[inds]
+            return x, y
+
+
+def window_offsets(time, tmin, tmax):
+    """
+    Convert per-row (tmin, tmax] bounds into integer [start, stop) offsets
+    along a sorted time axis, flagging rows with missing bounds as invalid
+    """
+    tmin = np.asarray(tmin, dtype='float64')
+    tmax = np.asarray(tmax, dtype='float64')
+    valid = ~np.isnan(tmin) & ~np.isnan(tmax)
+    start = np.searchsorted(time, np.where(valid, tmin, -np.inf), side='right')
+    stop = np.searchsorted(time, np.where(valid, tmax, -np.inf), side='right')
+    return start, stop, valid
+
+
+def window_stats(array, start, stop, valid=None):
+    """
+    Compute min, max and mean of array[i, start[i]:stop[i]] for every row i
+
+    Means use cumulative sums and min/max use a sparse table over the time axis,
+    so the cost is one pass over the (row, time) array rather than one per row.
+    As with numpy reductions, a NaN anywhere in a window gives NaN, and empty or
+    invalid windows give NaN.
+    """
+    array = np.asarray(array)
+    n, nt = array.shape
+    start = np.asarray(start, dtype='int64')
+    stop = np.asarray(stop, dtype='int64')
+    if valid is None:
+        valid = np.ones(n, dtype=bool)
+    valid = valid & (stop > start)
+
+    dtype = np.result_type(array.dtype, np.float32)
+    out = {key: np.full(n, np.NaN, dtype=dtype) for key in ['min', 'max', 'mean']}
+    if not valid.any():
+        return out
+
+    rows = np.nonzero(valid)[0]
+    s = start[rows]
+    e = stop[rows]
+    length = e - s
+
+    nans = np.isnan(array)
+    csum = np.zeros((n, nt + 1))
+    np.cumsum(np.where(nans, 0, array), axis=1, out=csum[:, 1:])
+    cnan = np.zeros((n, nt + 1), dtype='int64')
+    np.cumsum(nans, axis=1, out=cnan[:, 1:])
+    total = csum[rows, e] - csum[rows, s]
+    has_nan = (cnan[rows, e] - cnan[rows, s]) > 0
+    out['mean'][rows] = np.where(has_nan, np.NaN, total / length)
+
+    # level k of the sparse table holds reductions over windows of length 2 ** k
+    levels = np.floor(np.log2(length)).astype('int64')
+    lo, hi = array, array
+    for k in range(levels.max() + 1):
+        if k > 0:
+            width = 2 ** (k - 1)
+            lo = np.minimum(lo[:, :-width], lo[:, width:])
+            hi = np.maximum(hi[:, :-width], hi[:, width:])
+        at = levels == k
+        if at.any():
+            r, a, b = rows[at], s[at], e[at] - 2 ** k
+            out['min'][r] = np.minimum(lo[r, a], lo[r, b])
+            out['max'][r] = np.maximum(hi[r, a], hi[r, b])
+
+    return out
 
 
 def weighted_mean(ds, *args, **kwargs):
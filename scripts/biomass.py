@@ -1,10 +1,12 @@
+import os
 import sys
 
 import numpy as np
 import pandas as pd
+import xarray as xr
 from tqdm import tqdm
 
-from carbonplan_forest_risks import fit, load
+from carbonplan_forest_risks import fit, load, runner, utils
 
 args = sys.argv
 
@@ -15,6 +17,31 @@ else:
 
 variables = ['tmean', 'ppt']
 
+cmip_models = [
+    'CanESM5-CanOE',
+    'MIROC-ES2L',
+    'ACCESS-CM2',
+    'ACCESS-ESM1-5',
+    'MRI-ESM2-0',
+    'MPI-ESM1-2-LR',
+]
+scenarios = ['ssp245', 'ssp370', 'ssp585']
+
+inputs = load.fia_paths('conus') + ['carbonplan-downscaling/' + load.terraclim_prefix('annual')]
+inputs += [
+    'carbonplan-downscaling/' + load.cmip_prefix(cmip_model, scenario)
+    for cmip_model in cmip_models
+    for scenario in scenarios + ['historical']
+]
+
+fit_kwargs = {'group': 'type_code', 'noise': 'gamma'}
+
+state = runner.RunState(
+    'biomass',
+    params={'store': store, 'variables': variables, 'fit': fit_kwargs},
+    inputs=runner.store_inputs(store, inputs),
+)
+
 print('[biomass] loading data')
 df = load.fia(store=store, states='conus')
 df = load.terraclim(
@@ -25,17 +52,13 @@ df = load.terraclim(
     sampling='annual',
     df=df,
 )
-type_codes = df['type_code'].unique()
+points = utils.PointIndex.from_df(df)
 
 print('[biomass] fitting models')
-models = {}
-for code in tqdm(type_codes):
-    df_type = df[df['type_code'] == code].reset_index()
-    x = df_type['age']
-    y = df_type['biomass']
-    f = [df_type['tmean_mean'], df_type['ppt_mean']]
-    model = fit.growth(x=x, y=y, f=f, noise='gamma')
-    models[code] = model
+models = state.compute(
+    'fit',
+    lambda: fit.growth_grouped(df, max_workers=os.cpu_count(), **fit_kwargs),
+)
 
 print('[biomass] preparing for evaluations')
 pf = pd.DataFrame()
@@ -44,62 +67,65 @@ pf['lon'] = df['lon']
 pf['type_code'] = df['type_code']
 
 print('[biomass] evaluating predictions on training data')
-for code in type_codes:
-    if code in models.keys():
-        model = models[code]
-        inds = df['type_code'] == code
-        x = df[inds]['age']
-        f = [df[inds]['tmean_mean'], df[inds]['ppt_mean']]
-        pf.loc[inds, 'historical'] = model.predict(x, f)
+pf['historical'] = models.predict(df['age'], [df['tmean_mean'], df['ppt_mean']], df['type_code'])
 
 print('[biomass] evaluating predictions on future climate models')
-targets = list(map(lambda x: str(x), np.arange(2005, 2100, 10)))
-cmip_models = [
-    'CanESM5-CanOE',
-    'MIROC-ES2L',
-    'ACCESS-CM2',
-    'ACCESS-ESM1-5',
-    'MRI-ESM2-0',
-    'MPI-ESM1-2-LR',
+targets = np.arange(2005, 2100, 10)
+plots = df[['age', 'year', 'type_code']].copy()
+
+# stack climate features for every gcm, scenario and target into (gcm, scenario, target, plot)
+f = [
+    xr.DataArray(
+        np.full((len(cmip_models), len(scenarios), len(targets), len(plots)), np.NaN),
+        dims=['gcm', 'scenario', 'target', 'plot'],
+        coords={'gcm': cmip_models, 'scenario': scenarios, 'target': targets},
+    )
+    for _ in variables
 ]
-scenarios = ['ssp245', 'ssp370', 'ssp585']
 for it in tqdm(range(len(targets))):
     target = targets[it]
-    tlim = (str(int(target) - 10), str(int(target) + 9))
-    for cmip_model in cmip_models:
-        for scenario in scenarios:
-            key = cmip_model + '_' + scenario + '_' + target
-            df = load.cmip(
-                store=store,
-                tlim=(int(tlim[0]), int(tlim[1])),
-                variables=variables,
-                historical=True if int(tlim[0]) < 2015 else False,
-                model=cmip_model,
-                scenario=scenario,
-                sampling='annual',
-                df=df,
+    tlim = (target - 10, target + 9)
+    for g, cmip_model in enumerate(cmip_models):
+        for s, scenario in enumerate(scenarios):
+            features = state.compute(
+                (cmip_model, scenario, target),
+                lambda: load.cmip(
+                    store=store,
+                    tlim=(int(tlim[0]), int(tlim[1])),
+                    variables=variables,
+                    historical=True if int(tlim[0]) < 2015 else False,
+                    model=cmip_model,
+                    scenario=scenario,
+                    sampling='annual',
+                    df=df,
+                    points=points,
+                )[[f'{var}_mean' for var in variables]].values,
             )
-            pf[key] = np.NaN
-            for code in type_codes:
-                if code in models.keys():
-                    model = models[code]
-                    inds = df['type_code'] == code
-                    x = df[inds]['age']
-                    year = df[inds]['year']
-                    f = [df[inds]['tmean_mean'], df[inds]['ppt_mean']]
-                    if it == 0:
-                        pf.loc[inds, key] = model.predict(
-                            np.maximum(x + (float(target) - year), 0), f
-                        )
-                    else:
-                        prev_target = targets[it - 1]
-                        prev_key = cmip_model + '_' + scenario + '_' + prev_target
-                        diff = model.predict(x + (float(target) - year), f) - model.predict(
-                            x + (float(prev_target) - year), f
-                        )
-                        pf.loc[inds, key] = np.maximum(pf[prev_key][inds] + diff, 0)
-
-pf['r2'] = pf['type_code'].map(lambda k: models[k].train_r2)
-pf['scale'] = pf['type_code'].map(lambda k: models[k].scale)
-
-pf.to_parquet('data/biomass_v2.parquet', compression='gzip', engine='fastparquet')
+            for v in range(len(variables)):
+                f[v][g, s, it] = features[:, v]
+
+projection = models.project(plots['age'], plots['year'], f, plots['type_code'], targets)
+
+pf['r2'] = pf['type_code'].map(models.params['train_r2'])
+pf['scale'] = pf['type_code'].map(models.params['scale'])
+
+ds = xr.Dataset.from_dataframe(pf.reset_index(drop=True).rename_axis('plot'))
+ds['projection'] = projection
+ds.to_zarr('data/biomass_v2.zarr', mode='w')
+
+# regrid.py reads the wide layout with one {gcm}_{scenario}_{target} column per projection
+columns = {
+    f'{cmip_model}_{scenario}_{target}': projection.sel(
+        gcm=cmip_model, scenario=scenario, target=target
+    ).values
+    for target in targets
+    for cmip_model in cmip_models
+    for scenario in scenarios
+}
+wide = pd.concat(
+    [pf[['lat', 'lon', 'type_code', 'historical']], pd.DataFrame(columns, index=pf.index)],
+    axis=1,
+)
+wide['r2'] = pf['r2']
+wide['scale'] = pf['scale']
+wide.to_parquet('data/biomass_v2.parquet', compression='gzip', engine='fastparquet')
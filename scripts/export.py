@@ -7,7 +7,7 @@ import numpy as np
 from cmip6_downscaling.workflows.share import get_cmip_runs
 from dask.diagnostics import ProgressBar
 
-from carbonplan_forest_risks import load
+from carbonplan_forest_risks import load, utils
 
 # parameters
 variables = ['ppt', 'tmean', 'pdsi', 'cwd', 'pet', 'vpd', 'rh']
@@ -50,6 +50,7 @@ def terraclimate_fia_long():
     # generate long data w/ terraclim
 
     df_fia = load.fia(store='az', states=states, clean=False)
+    points = utils.PointIndex.from_df(df_fia)
 
     for target in targets_terraclimate:
         tlim = (str(int(target) - 5), str(int(target) + 4))
@@ -60,6 +61,7 @@ def terraclimate_fia_long():
             tlim=(int(tlim[0]), int(tlim[1])),
             variables=variables,
             df=df_fia,
+            points=points,
             sampling='annual',
         )
 
@@ -70,6 +72,7 @@ def cmip_fia_long(cmip_table, method):
     # generate long data w/ cmip
 
     df_fia = load.fia(store='az', states=states, clean=False)
+    points = utils.PointIndex.from_df(df_fia)
     keep_vars = (
         ['lat', 'lon', 'plot_cn']
         + [var + '_min' for var in variables]
@@ -93,6 +96,7 @@ def cmip_fia_long(cmip_table, method):
                 tlim=(int(tlim[0]), int(tlim[1])),
                 variables=variables,
                 df=df_fia,
+                points=points,
                 model=row.model,
                 scenario=row.scenario,
                 member=row.member,
@@ -1,9 +1,11 @@
+import os
 import sys
 
 import numpy as np
 from tqdm import tqdm
 
-from carbonplan_forest_risks import fit, load, prepare, utils
+from carbonplan_forest_risks import fit, load, prepare, runner, utils
+from carbonplan_forest_risks.load.cmip import members
 
 args = sys.argv
 
@@ -15,29 +17,50 @@ else:
 data_vars = ['ppt', 'tavg']
 data_aggs = ['sum', 'mean']
 
-print('[insects] loading data')
-df = load.fia(store=store, states='conus', group_repeats=True)
-df = load.terraclim(
-    store=store,
-    tlim=(int(df['year_0'].min()), 2020),
-    data_vars=data_vars,
-    data_aggs=data_aggs,
-    df=df,
-    group_repeats=True,
+cmip_models = ['BCC-CSM2-MR', 'ACCESS-ESM1-5', 'CanESM5', 'MIROC6', 'MPI-ESM1-2-LR']
+scenarios = ['ssp245', 'ssp370', 'ssp585']
+
+inputs = load.fia_paths('conus') + ['carbonplan-downscaling/' + load.terraclim_prefix('annual')]
+inputs += [
+    'carbonplan-downscaling/' + load.cmip_prefix(cmip_model, scenario)
+    for cmip_model in cmip_models
+    for scenario in scenarios
+    if cmip_model in members  # load.cmip cannot open models without a known member
+]
+
+fit_kwargs = {'log': True, 'max_iter': 1000, 'min_y_sum': 1}
+
+state = runner.RunState(
+    'insects',
+    params={'store': store, 'data_vars': data_vars, 'data_aggs': data_aggs, 'fit': fit_kwargs},
+    inputs=runner.store_inputs(store, inputs),
 )
 
-print('[insects] prepare for fitting')
-x, y, pf = prepare.insects(df)
-x_z, x_mean, x_std = utils.zscore_2d(x)
-codes = pf['type_code'].unique()
 
-print('[insects] fit models')
-models = {}
-for code in tqdm(codes):
-    inds = pf['type_code'] == code
-    if (y[inds].sum() > 1) & (y[inds].sum() > 1):
-        model = fit.hurdle(x=x_z[inds], y=y[inds])
-        models[code] = model
+def fit_models():
+    print('[insects] loading data')
+    df = load.fia(store=store, states='conus', group_repeats=True)
+    df = load.terraclim(
+        store=store,
+        tlim=(int(df['year_0'].min()), 2020),
+        data_vars=data_vars,
+        data_aggs=data_aggs,
+        df=df,
+        group_repeats=True,
+    )
+
+    print('[insects] prepare for fitting')
+    x, y, pf = prepare.insects(df)
+    x_z, x_mean, x_std = utils.zscore_2d(x)
+
+    print('[insects] fit models')
+    models = fit.hurdle_grouped(
+        x_z, y, pf['type_code'].values, max_workers=os.cpu_count(), **fit_kwargs
+    )
+    return models, x_mean, x_std
+
+
+models, x_mean, x_std = state.compute('fit', fit_models)
 
 print('[insects] preparing for evaluations')
 df = load.fia(store=store, states='conus')
@@ -51,42 +74,39 @@ df = load.terraclim(
     data_aggs=data_aggs,
     df=df,
 )
-x, meta = prepare.insects(df, eval_only=True, duration=10)
-x_z = utils.zscore_2d(x, x_mean, x_std)
-for code in codes:
-    if code in models.keys():
-        model = models[code]
-        inds = df['type_code'] == code
-        pf.loc[inds, 'historical'] = model.predict(x=x_z[inds])
+
+
+def evaluate(df):
+    x, meta = prepare.insects(df, eval_only=True, duration=10)
+    x_z = utils.zscore_2d(x, x_mean, x_std)
+    return models.predict(x_z, df['type_code'].values)
+
+
+pf['historical'] = state.compute('historical', lambda: evaluate(df))
 
 print('[insects] evaluating on future climate models')
 targets = list(map(lambda x: str(x), np.arange(2020, 2120, 20)))
-cmip_models = ['BCC-CSM2-MR', 'ACCESS-ESM1-5', 'CanESM5', 'MIROC6', 'MPI-ESM1-2-LR']
-scenarios = ['ssp245', 'ssp370', 'ssp585']
 for it in tqdm(range(len(targets))):
     target = targets[it]
     tlim = (str(int(target) - 5), str(int(target) + 4))
     for cmip_model in cmip_models:
         for scenario in scenarios:
             key = cmip_model + '_' + scenario + '_' + target
-            df = load.cmip(
-                store=store,
-                tlim=(int(tlim[0]), int(tlim[1])),
-                data_vars=data_vars,
-                data_aggs=data_aggs,
-                model=cmip_model,
-                scenario=scenario,
-                annual=True,
-                df=df,
+            pf[key] = state.compute(
+                (cmip_model, scenario, target),
+                lambda: evaluate(
+                    load.cmip(
+                        store=store,
+                        tlim=(int(tlim[0]), int(tlim[1])),
+                        data_vars=data_vars,
+                        data_aggs=data_aggs,
+                        model=cmip_model,
+                        scenario=scenario,
+                        annual=True,
+                        df=df,
+                    )
+                ),
             )
-            pf[key] = np.NaN
-            x, meta = prepare.insects(df, eval_only=True, duration=10)
-            x_z = utils.zscore_2d(x, x_mean, x_std)
-            for code in codes:
-                if code in models.keys():
-                    model = models[code]
-                    inds = df['type_code'] == code
-                    pf.loc[inds, key] = model.predict(x=x_z[inds])
 
 pf['r2'] = pf['type_code'].map(lambda k: models[k].train_r2 if k in models.keys() else np.NaN)
 
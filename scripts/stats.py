@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import pandas as pd
 
@@ -44,37 +46,29 @@ def score(x, y, model, da, method):
     }
 
 
-def crossval(x, y, selection, da, method):
-    inds = np.zeros(da.shape)
-    inds[selection, :, :] = 1
-    inds = inds.flatten()
-    train_x = x[inds == 0]
-    train_y = y[inds == 0]
-    test_x = x[inds == 1]
-    test_y = y[inds == 1]
-    model = fit.hurdle(train_x, train_y, log=False)
-    return score(test_x, test_y, model, da[selection], method)
+def holdout(selection, da):
+    """fold fitting on every time step outside selection"""
+    return fit.BlockFold(len(da['time']), train=np.flatnonzero(~np.asarray(selection)))
 
 
-def shuffle(x, y, da, method='months'):
+def shuffled(da, method='months'):
+    """fold fitting on y shuffled by month, by year or across all rows"""
+    n_blocks = len(da['time'])
     if 'months' in method:
-        inds = np.arange(len(da['time'].values)).copy()
+        inds = np.arange(n_blocks)
         np.random.shuffle(inds)
-        y = y.copy().reshape(da.shape)[inds].flatten()
+        return fit.BlockFold(n_blocks, order=inds)
     elif 'years' in method:
         years = pd.to_datetime(da['time'].values).year
         scrambled = years.unique().values.copy()
         np.random.shuffle(scrambled)
         inds = np.array([np.argwhere(years == y) for y in scrambled]).flatten()
-        y = y.copy().reshape(da.shape)[inds].flatten()
+        return fit.BlockFold(n_blocks, order=inds)
     elif 'all' in method:
-        y = y.copy()
-        np.random.shuffle(y)
+        return fit.BlockFold(n_blocks, seed=np.random.randint(2**31))
     else:
         print(f"shuffling method='{method}' not implemented")
-
-    model = fit.hurdle(x, y, log=False)
-    return score(x, y, model, da, method)
+    return fit.BlockFold(n_blocks)
 
 
 def append(df, results):
@@ -127,33 +121,44 @@ df = append(df, results)
 years = pd.to_datetime(mtbs['time'].values).year
 nruns = 10
 
+# each fold is a compact spec the workers expand, scored on (fold, test selection, da, method)
+folds = []
+evaluations = []
+
 print('[stats] split halves cross validation')
 for index in range(nruns):
     scrambled = years.unique().values.copy()
     np.random.shuffle(scrambled)
     subset = scrambled[0 : round(len(scrambled) / 2)]
-    selection = [y in subset for y in years]
-    results = crossval(x_z, y, selection, mtbs['monthly'], f'split_halves_{index}')
-    df = append(df, results)
+    selection = np.array([y in subset for y in years])
+    folds.append(holdout(selection, mtbs['monthly']))
+    evaluations.append((selection, mtbs['monthly'][selection], f'split_halves_{index}'))
 
 print('[stats] extrapolation cross validation')
 for index, threshold in enumerate([2005, 2006, 2007, 2008, 2009, 2010, 2011, 2012, 2013, 2014]):
     selection = years > threshold
-    results = crossval(x_z, y, selection, mtbs['monthly'], f'extrapolate_{index}')
-    df = append(df, results)
+    folds.append(holdout(selection, mtbs['monthly']))
+    evaluations.append((selection, mtbs['monthly'][selection], f'extrapolate_{index}'))
 
 print('[stats] shuffling')
-for index in range(nruns):
-    results = shuffle(x_z, y, mtbs['monthly'], f'shuffle_months_{index}')
-    df = append(df, results)
-
-for index in range(nruns):
-    results = shuffle(x_z, y, mtbs['monthly'], f'shuffle_years_{index}')
-    df = append(df, results)
-
-for index in range(nruns):
-    results = shuffle(x_z, y, mtbs['monthly'], f'shuffle_all_{index}')
-    df = append(df, results)
+for kind in ['months', 'years', 'all']:
+    for index in range(nruns):
+        method = f'shuffle_{kind}_{index}'
+        folds.append(shuffled(mtbs['monthly'], method))
+        evaluations.append((None, mtbs['monthly'], method))
+
+# warm start every fold from the full-data model, sharing x_z and y with the workers
+# each worker copies its fold's training rows out of the shared x_z, so keep the pool small
+max_workers = min(4, os.cpu_count())
+models = fit.hurdle_folds(x_z, y, folds, log=False, init=model, max_workers=max_workers)
+for fold_model, fold, (selection, da, method) in zip(models, folds, evaluations):
+    test_x = x_z
+    test_y = fold.target(y)
+    if selection is not None:
+        test = fold.blocks(selection, len(y))
+        test_x = test_x[test]
+        test_y = test_y[test]
+    df = append(df, score(test_x, test_y, fold_model, da, method))
 
 df = df[['method', 'roc', 'r2', 'annual_r2', 'seasonal_r2', 'spatial_r2', 'bias']]
 
@@ -2,3 +2,823 @@ def test_version():
     from carbonplan_forest_risks import version
 
     assert version != '0.0.0'
+
+
+def test_window_stats():
+    import numpy as np
+
+    from carbonplan_forest_risks import utils
+
+    time = np.arange(2000, 2010)
+    array = np.arange(20, dtype='float').reshape(2, 10)
+    array[1, 4] = np.NaN
+    tmin = np.array([2001, 2001])
+    tmax = np.array([2005, np.NaN])
+    stats = utils.window_stats(array, *utils.window_offsets(time, tmin, tmax))
+
+    assert stats['min'][0] == 2 and stats['max'][0] == 5 and stats['mean'][0] == 3.5
+    assert all(np.isnan(stats[key][1]) for key in ['min', 'max', 'mean'])
+
+    # random windows match the per-row mask loop load.terraclim used to run, including
+    # NaN values, empty or out of range windows and NaN bounds
+    rng = np.random.default_rng(0)
+    time = np.arange(1980, 2020)
+    array = rng.normal(size=(500, len(time)))
+    array[rng.random(array.shape) < 0.02] = np.NaN
+    tmin = rng.integers(1975, 2025, 500).astype(float)
+    tmax = tmin + rng.integers(-2, 15, 500)
+    tmin[rng.random(500) < 0.1] = np.NaN
+    tmax[rng.random(500) < 0.1] = np.NaN
+    stats = utils.window_stats(array, *utils.window_offsets(time, tmin, tmax))
+
+    for i, (a, lo, hi) in enumerate(zip(array, tmin, tmax)):
+        t = (time > lo) & (time <= hi) if (~np.isnan(lo) & ~np.isnan(hi)) else []
+        if len(t) > 0 and t.sum() > 0:
+            expected = {'min': a[t].min(), 'max': a[t].max(), 'mean': a[t].mean()}
+        else:
+            expected = {'min': np.NaN, 'max': np.NaN, 'mean': np.NaN}
+        for key, value in expected.items():
+            np.testing.assert_allclose(stats[key][i], value, err_msg=f'row {i} {key}')
+
+
+def test_point_index_gather():
+    import numpy as np
+    import pytest
+    import xarray as xr
+
+    from carbonplan_forest_risks import utils
+
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, 300, 50)
+    cols = rng.integers(0, 400, 50)
+    lat, lon = utils.rowcol_to_latlon(
+        np.append(rows, rows[:5]), np.append(cols, cols[:5]), res=4000
+    )
+    points = utils.PointIndex(lat, lon)
+    assert len(points) == 55 and len(points.rows) <= 50
+
+    values = rng.random((3, 300, 400)).astype('float32')
+    ds = xr.Dataset({'ppt': (['time', 'y', 'x'], values)}, coords={'time': [1, 2, 3]})
+    ds = ds.chunk({'time': 2, 'y': 64, 'x': 96})
+    expected = points.gather(ds)
+    gathered = points.gather(ds, method='chunks', max_workers=4)
+    np.testing.assert_array_equal(gathered['ppt'].values, expected['ppt'].values)
+    assert gathered['ppt'].dims == ('time', 'c')
+    expanded = points.expand(expected['ppt'].values)
+    np.testing.assert_array_equal(expanded[:, :50], values[:, rows, cols])
+
+    for method in ['isel', 'chunks']:
+        with pytest.raises(ValueError, match='outside'):
+            points.gather(ds.isel(y=slice(0, 100)), method=method)
+
+
+def test_read_through_cache(tmp_path):
+    import pandas as pd
+
+    from carbonplan_forest_risks.setup.cache import CachedPath, ReadThroughCache
+
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    for name in ['a', 'b', 'c']:
+        pd.DataFrame({'x': range(100)}).to_parquet(remote / f'{name}.parquet')
+    size = (remote / 'a.parquet').stat().st_size
+
+    cache = ReadThroughCache(directory=tmp_path / 'cache', max_size=2 * size, ttl=0)
+    path = CachedPath(remote, cache)
+
+    assert pd.read_parquet(path / 'a.parquet')['x'].sum() == 4950
+    assert path.get_mapper()['a.parquet'] == (remote / 'a.parquet').read_bytes()
+    assert cache.size() == size
+
+    # a changed remote file gets a fresh entry and least recently used entries are evicted
+    pd.DataFrame({'x': range(10)}).to_parquet(remote / 'a.parquet')
+    assert pd.read_parquet(path / 'a.parquet')['x'].sum() == 45
+    pd.read_parquet(path / 'b.parquet')
+    pd.read_parquet(path / 'c.parquet')
+    assert cache.size() <= 2 * size
+    assert 'missing.parquet' not in path.get_mapper()
+
+    # within the ttl, cached entries are served without contacting the remote
+    cached = CachedPath(remote, ReadThroughCache(directory=tmp_path / 'cache', ttl=3600))
+    (remote / 'c.parquet').unlink()
+    assert pd.read_parquet(cached / 'c.parquet')['x'].sum() == 4950
+    assert 'c.parquet' in cached.get_mapper() and 'c.parquet' not in path.get_mapper()
+
+
+def test_fia_state_pushdown_and_pivot(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+
+    from carbonplan_forest_risks.load.fia import (
+        fia_paths,
+        fia_state,
+        fia_state_columns,
+        forest_type_remap,
+        pivot_repeats,
+    )
+
+    rng = np.random.default_rng(0)
+    n = 200
+    long = pd.DataFrame({var: rng.uniform(0, 100, n) for var in fia_state_columns})
+    # mostly valid rows, with a few of each kind that the filters drop
+    long['STDAGE'] = rng.choice([np.NaN, 0, 999] + [50] * 7, n)
+    long['FLDTYPCD'] = rng.choice([np.NaN, 950, 999, 1000] + [101] * 6, n)
+    long['MEASYEAR'] = rng.choice([np.NaN, 2000, 9999] + [2010] * 7, n)
+    long['INVYR'] = rng.choice([9999] + [2005] * 9, n)
+    long['adj_ag_biomass'] = rng.choice([0] + [10.0] * 9, n)
+    long['DSTRBCD1'] = rng.choice([10] + [0] * 9, n)
+    long['COND_STATUS_CD'] = rng.choice([2] + [1] * 9, n)
+    long['CONDPROP_UNADJ'] = rng.uniform(0, 1, n)
+    long['plt_uid'] = rng.integers(0, 30, n)
+    long['CONDID'] = rng.integers(1, 3, n)
+    long['flag'] = rng.random(n) < 0.5
+    long['count'] = rng.integers(0, 10, n)
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    path = tmp_path / 'workdir' / fia_paths('aa')[0]
+    path.parent.mkdir(parents=True)
+    long.to_parquet(path, row_group_size=50)
+
+    # pushed-down filters select the same rows as masking the full table
+    for clean in [True, False]:
+        expected = long[
+            (long['MEASYEAR'] < 9999)
+            & (long['INVYR'] < 9999)
+            & (long['FLDTYPCD'] != 999)
+            & (long['FLDTYPCD'] != 950)
+            & (long['FLDTYPCD'] <= 983)
+        ]
+        if clean:
+            expected = expected[
+                (expected['adj_ag_biomass'] > 0)
+                & (expected['STDAGE'] < 999)
+                & (expected['STDAGE'] > 0)
+                & (expected['DSTRBCD1'] == 0)
+                & (expected['COND_STATUS_CD'] == 1)
+                & (expected['CONDPROP_UNADJ'] > 0.3)
+                & (expected['MEASYEAR'] > 2000)
+                & (expected['INVYR'] > 2000)
+            ]
+        expected = expected.rename(columns=fia_state_columns)[list(fia_state_columns.values())]
+        expected['type_code'] = expected['type_code'].map(forest_type_remap)
+        expected['state'] = 'AA'
+        df = fia_state('local', 'aa', clean)
+        pd.testing.assert_frame_equal(df, expected.reset_index(drop=True))
+
+    # the single-pass reshape matches pivoting each variable in turn
+    keys = ['plt_uid', 'CONDID']
+    variables = ['MEASYEAR', 'LAT', 'flag', 'count']
+    long = long.sort_values(keys + ['MEASYEAR'])
+    long['tmp_idx'] = long.groupby(keys).cumcount().astype(str)
+    expected = pd.concat(
+        [
+            long.assign(tmp_idx=var + '_' + long['tmp_idx']).pivot(
+                index=keys, columns='tmp_idx', values=var
+            )
+            for var in variables
+        ],
+        axis=1,
+    )
+    wide = pivot_repeats(long, keys, variables)
+    pd.testing.assert_frame_equal(wide, expected, check_names=False)
+    complete = long.groupby(keys).head(1)
+    wide = pivot_repeats(complete, keys, variables)
+    expected = complete.set_index(keys)[variables].add_suffix('_0')
+    pd.testing.assert_frame_equal(wide, expected)
+
+
+def make_raw_fia_state(path, state, n_plots=20, seed=0):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    cn = np.arange(n_plots) + 1000.0
+    plot = pd.DataFrame(
+        {
+            'CN': cn,
+            'PREV_PLT_CN': np.where(np.arange(n_plots) % 2, cn - 1, np.NaN),
+            'PLOT_STATUS_CD': 1,
+            'LAT': rng.uniform(30, 45, n_plots),
+            'LON': rng.uniform(-120, -80, n_plots),
+            'ELEV': rng.uniform(0, 3000, n_plots),
+            'KINDCD': 1,
+            'MEASYEAR': 2000 + np.arange(n_plots) % 10,
+            'REMPER': 5.0,
+            'RDDISTCD': 1,
+            'ECOSUBCD': 'M242A',
+        }
+    )
+    cond_vars = ['STDAGE', 'BALIVE', 'SICOND', 'SISP', 'OWNCD', 'SITECLCD', 'PHYSCLCD', 'ALSTK']
+    cond_vars += ['ALSTKCD', 'GSSTK', 'GSSTKCD', 'FORTYPCD', 'FLDTYPCD', 'SLOPE', 'ASPECT']
+    cond_vars += ['COND_STATUS_CD', 'COND_NONSAMPLE_REASN_CD', 'INVYR']
+    cond = pd.DataFrame({var: rng.integers(1, 100, n_plots).astype(float) for var in cond_vars})
+    cond['PLT_CN'] = cn
+    cond['CONDID'] = 1
+    cond['CN'] = cn + 10**6
+    cond['CONDPROP_UNADJ'] = rng.uniform(0.3, 1, n_plots)
+    for var in ['DSTRBCD1', 'DSTRBCD2', 'DSTRBCD3']:
+        cond[var] = rng.choice([0, 10, 30, 80], n_plots)
+    for var in ['TRTCD1', 'TRTCD2', 'TRTCD3']:
+        cond[var] = rng.choice([0, 10, 20], n_plots)
+
+    n_trees = 10 * n_plots
+    tree = pd.DataFrame(
+        {
+            'CN': np.arange(n_trees) + 10.0**7,
+            'PLT_CN': rng.choice(cn, n_trees),
+            'DIA': np.where(rng.random(n_trees) < 0.1, np.NaN, rng.uniform(1, 30, n_trees)),
+            'DIACALC': rng.uniform(1, 30, n_trees),
+            'HT': rng.uniform(5, 100, n_trees),
+            'ACTUALHT': rng.uniform(5, 100, n_trees),
+            'STATUSCD': rng.choice([1, 2], n_trees).astype(float),
+            'CONDID': 1.0,
+            'TPA_UNADJ': np.where(rng.random(n_trees) < 0.1, np.NaN, rng.uniform(1, 10, n_trees)),
+            'AGENTCD': rng.choice([np.NaN, 10, 20, 30, 50, 70, 80], n_trees),
+            'TPAGROW_UNADJ': rng.uniform(1, 10, n_trees),
+            'TPAMORT_UNADJ': rng.choice([0, 1.0], n_trees),
+            'TPAREMV_UNADJ': rng.uniform(0, 1, n_trees),
+            'DIACHECK': 0.0,
+            'CARBON_AG': rng.uniform(10, 1000, n_trees),
+            'CARBON_BG': rng.uniform(1, 100, n_trees),
+        }
+    )
+    for name, df in [('plot', plot), ('cond', cond), ('tree', tree)]:
+        df.to_parquet(path / f'{name}_{state}.parquet')
+
+
+def test_generate_uids():
+    import numpy as np
+    import pandas as pd
+
+    from carbonplan_forest_risks.preprocess.fia import generate_uids
+
+    # shuffled remeasurement chains, some branching and some pointing at unseen CNs
+    rng = np.random.default_rng(0)
+    cn = rng.permutation(200) + 1000.0
+    prev = np.where(rng.random(200) < 0.7, rng.choice(cn, 200), np.NaN)
+    prev[:5] = np.arange(5) + 5000.0
+    data = pd.DataFrame({'CN': cn, 'PREV_PLT_CN': prev})
+
+    # reference: walk the graph from each node in insertion order, as networkx does
+    neighbors = {}
+    for a, b in zip(cn, prev):
+        neighbors.setdefault(a, set())
+        if not np.isnan(b):
+            neighbors.setdefault(b, set())
+            neighbors[a].add(b)
+            neighbors[b].add(a)
+    expected, uid = {}, 0
+    for node in neighbors:
+        if node in expected:
+            continue
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current not in expected:
+                expected[current] = uid
+                stack.extend(neighbors[current])
+        uid += 1
+
+    uids = generate_uids(data)
+    assert uids.to_dict() == expected
+    assert uids.nunique() < len(cn)
+
+
+def test_preprocess_fia_batch(tmp_path):
+    import pandas as pd
+
+    from carbonplan_forest_risks import preprocess
+
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    for seed, state in enumerate(['aa', 'bb']):
+        make_raw_fia_state(raw, state, seed=seed)
+
+    kwargs = dict(raw_path=str(raw), out_path=str(tmp_path / 'long'), max_workers=2)
+    manifest = preprocess.fia_batch(['AA', 'BB'], **kwargs)
+    assert {record['status'] for record in manifest.values()} == {'done'}
+    df = pd.read_parquet(manifest['aa']['output'])
+    assert len(df) == 20 and df['plt_uid'].nunique() == 10
+
+    # unchanged inputs are skipped, changed inputs are rerun
+    make_raw_fia_state(raw, 'bb', n_plots=30)
+    rerun = preprocess.fia_batch(['aa', 'bb'], **kwargs)
+    assert rerun['aa']['completed'] == manifest['aa']['completed']
+    assert rerun['bb']['rows'] == 30
+
+
+def test_preprocess_state_row_groups(tmp_path):
+    import fastparquet
+    import pandas as pd
+
+    from carbonplan_forest_risks.preprocess.fia import preprocess_state
+
+    make_raw_fia_state(tmp_path, 'aa', n_plots=40)
+    single = preprocess_state('aa', save=False, raw_path=str(tmp_path))
+
+    # the tree table is streamed by row group, which must not change the result
+    path = tmp_path / 'tree_aa.parquet'
+    tree = pd.read_parquet(path)
+    fastparquet.write(str(path), tree, row_group_offsets=list(range(0, len(tree), 37)))
+    assert fastparquet.ParquetFile(str(path)).info['row_groups'] > 1
+    chunked = preprocess_state('aa', save=False, raw_path=str(tmp_path))
+    pd.testing.assert_frame_equal(chunked, single)
+
+
+def test_tree_condition_stats(tmp_path):
+    import math
+
+    import numpy as np
+    import pandas as pd
+
+    from carbonplan_forest_risks.preprocess.fia import (
+        BULK_AGENT_MAP,
+        condition_tree_stats,
+        preprocess_state,
+        read_tree_chunks,
+        tree_condition_partials,
+    )
+
+    make_raw_fia_state(tmp_path, 'aa')
+    tree = pd.read_parquet(tmp_path / 'tree_aa.parquet')
+    # streamed in small batches from one row group, the stats match a single pass
+    chunks = list(read_tree_chunks(tmp_path / 'tree_aa.parquet', batch_size=37))
+    assert len(chunks) > 1
+    stats = condition_tree_stats([tree_condition_partials(chunk) for chunk in chunks])
+    single = condition_tree_stats(
+        [tree_condition_partials(next(read_tree_chunks(tmp_path / 'tree_aa.parquet')))]
+    )
+    pd.testing.assert_frame_equal(stats.sort_index(), single.sort_index())
+
+    # reference: per-condition groupby on the tree table, as preprocess_state used to do
+    measured = ['DIA', 'DIACALC', 'HT', 'ACTUALHT', 'TPA_UNADJ', 'TPAGROW_UNADJ', 'CARBON_AG']
+    tree[measured + ['CARBON_BG']] = tree[measured + ['CARBON_BG']].astype('float32')
+    tree = tree.astype('float64')
+    tree['unadj_ag_biomass'] = tree['CARBON_AG'] * tree['TPA_UNADJ'] * 2 / 892.1791216197013
+    tree['unadj_bg_biomass'] = tree['CARBON_BG'] * tree['TPA_UNADJ'] * 2 / 892.1791216197013
+    tree['unadj_basal_area'] = math.pi * (tree['DIA'] / (2 * 12)) ** 2 * tree['TPA_UNADJ']
+    keys = ['PLT_CN', 'CONDID']
+    alive = tree[tree['STATUSCD'] == 1].groupby(keys)
+    sums = ['unadj_ag_biomass', 'unadj_bg_biomass', 'unadj_basal_area']
+    expected = alive[sums].sum().join(alive[['HT', 'ACTUALHT']].mean())
+
+    mort = tree[(tree['AGENTCD'] >= 10) & (tree['AGENTCD'] < 90)].copy()
+    mort['TPA_UNADJ'] = mort['TPA_UNADJ'].fillna(mort['TPAGROW_UNADJ'])
+    mort['DIA'] = mort['DIA'].fillna(mort['DIACALC'])
+    mort['unadj_basal_area'] = math.pi * (mort['DIA'] / (2 * 12)) ** 2 * mort['TPA_UNADJ']
+    mort = mort[(mort['TPA_UNADJ'] > 0) & (mort['unadj_basal_area'] > 0)]
+    pop = mort[(mort['TPAMORT_UNADJ'] > 0) & (mort['AGENTCD'] < 80)]
+    for name, subset in [
+        ('unadj_full_mort', mort[mort['AGENTCD'] < 80]),
+        ('unadj_pop_mort', pop),
+        ('unadj_removal', mort[mort['AGENTCD'] == 80]),
+    ]:
+        expected = expected.join(subset.groupby(keys)['unadj_basal_area'].sum().rename(name))
+    by_agent = pop.groupby(keys + [pop['AGENTCD'] // 10])['unadj_basal_area'].sum().unstack(2)
+    fraction = by_agent.div(by_agent.sum(axis=1), axis=0).fillna(0).round(3)
+    expected = expected.join(fraction.rename(columns=BULK_AGENT_MAP))
+
+    stats = stats.reindex(expected.index)
+    expected.index = expected.index.set_levels(expected.index.levels[1].astype('int32'), level=1)
+    pd.testing.assert_frame_equal(stats, expected, check_names=False, check_index_type=False)
+
+    # live tree stats sit between the condition variables and the disturbance flags
+    columns = list(preprocess_state('aa', save=False, raw_path=str(tmp_path)).columns)
+    order = [columns.index(c) for c in ['ACTUALHT', 'disturb_fire', 'unadj_pop_mort']]
+    assert order == sorted(order)
+
+
+def test_prepare_fire_matrix():
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    from carbonplan_forest_risks import collect, prepare
+
+    rng = np.random.default_rng(0)
+    shape = (24, 3, 4)
+    time = pd.date_range('2000-01-01', periods=24, freq='MS')
+    coords = {'time': time, 'y': range(3), 'x': range(4)}
+    dims = ['time', 'y', 'x']
+    climate = xr.Dataset(
+        {var: (dims, rng.normal(size=shape)) for var in ['tmean', 'ppt', 'cwd']}, coords=coords
+    )
+    climate['ppt'][:, 0, 0] = np.NaN
+    nftd = xr.DataArray(rng.random((2, 3, 4)), dims=['band', 'y', 'x'])
+    nftd[1, 2, 3] = np.NaN
+    mtbs = xr.Dataset({'monthly': (dims, rng.random(shape))}, coords=coords)
+    trends = {'tmean': {'climate_prepend': None, 'rolling_period': None}}
+
+    # reference: stack flattened climate, tiled nftd and dense trends, as before
+    expected = [climate[var].values.flatten() for var in climate.data_vars]
+    expected += [np.tile(a, [shape[0], 1, 1]).flatten() for a in nftd.values]
+    for signal in ['global', 'local']:
+        annual = prepare.annualize(climate, 'tmean', signal)
+        expected.append(np.broadcast_to(prepare.package_annualized(annual, shape, signal), shape))
+    expected = np.asarray([a.flatten() for a in expected]).T
+
+    kwargs = dict(add_global_climate_trends=trends, add_local_climate_trends=trends)
+    x, y = prepare.fire(climate, nftd, mtbs, **kwargs)
+    np.testing.assert_array_equal(x, expected)
+    np.testing.assert_array_equal(y, mtbs['monthly'].values.flatten())
+
+    # only fully finite rows are kept, and their indices scatter predictions back
+    x, y, inds = prepare.fire(climate, nftd, mtbs, dtype='float32', return_inds=True, **kwargs)
+    valid = np.isfinite(expected).all(axis=1)
+    np.testing.assert_array_equal(inds, np.flatnonzero(valid))
+    np.testing.assert_array_equal(x, expected[valid].astype('float32'))
+    ds = collect.fire(y, climate.assign(lat=climate.x, lon=climate.x), inds=inds)
+    np.testing.assert_array_equal(ds['prediction'].values.flatten()[inds], y)
+
+
+def test_collect_fire_reuse():
+    import numpy as np
+    import pytest
+    import xarray as xr
+
+    from carbonplan_forest_risks import collect
+
+    dims = ['time', 'y', 'x']
+    src = xr.Dataset(
+        {'lat': (['y', 'x'], np.zeros((3, 4))), 'lon': (['y', 'x'], np.zeros((3, 4)))},
+        coords={'time': range(2), 'y': range(3), 'x': range(4)},
+    )
+    inds = np.array([0, 5, 7, 23])
+    out = np.full((2, 3, 4), np.NaN, dtype='float32')
+
+    # a buffer reused with the same inds only has its indexed cells rewritten
+    for y in [np.arange(4.0), np.arange(4.0) + 10]:
+        ds = collect.fire(y, src, inds=inds, out=out)
+        assert np.shares_memory(ds['prediction'].values, out)
+        assert ds['prediction'].dims == tuple(dims)
+        np.testing.assert_array_equal(out.reshape(-1)[inds], y)
+        assert np.isnan(np.delete(out.reshape(-1), inds)).all()
+
+    expected = np.full(24, np.NaN)
+    expected[inds] = np.arange(4.0) + 10
+    fresh = collect.fire(np.arange(4.0) + 10, src, inds=inds, fill_value=np.NaN)
+    np.testing.assert_array_equal(fresh['prediction'].values.reshape(-1), expected)
+
+    with pytest.raises(ValueError, match='contiguous'):
+        collect.fire(y, src, inds=inds, out=np.zeros((2, 4, 3)).transpose(0, 2, 1))
+
+
+def test_hurdle_predict_blocks():
+    import numpy as np
+
+    from carbonplan_forest_risks import fit
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(1000, 3))
+    y = np.where(rng.random(1000) < 0.3, np.exp(0.3 * x[:, 0]), 0)
+    x[::97, 1] = np.NaN
+    model = fit.hurdle(x, y, log=True)
+
+    out = np.empty(len(x))
+    blocks = model.predict_blocks(x, out=out, block_size=128, max_workers=2)
+
+    assert blocks is out
+    np.testing.assert_allclose(blocks, model.predict(x))
+    np.testing.assert_allclose(model.predict_blocks(x, kind='prob'), model.predict_prob(x))
+    np.testing.assert_allclose(model.compile()(x.astype('float32')), model.predict(x), rtol=1e-5)
+
+
+def test_hurdle_grouped():
+    import numpy as np
+
+    from carbonplan_forest_risks import fit
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(1500, 3))
+    y = np.where(rng.random(1500) < 0.3, np.exp(0.3 * x[:, 0]), 0)
+    groups = np.repeat([3, 1, 2], 500)
+    y[groups == 2] = 0
+    models = fit.hurdle_grouped(x, y, groups, max_workers=2)
+
+    assert set(models) == {1, 3}
+    assert models.report.loc[2, 'error'] and models.report.loc[1, 'n_obs'] == 500
+    prediction = models.predict(x, groups)
+    np.testing.assert_allclose(prediction[:500], models[3].predict(x[:500]))
+    assert np.isnan(prediction[groups == 2]).all()
+
+    # rows without a group are left out of every fit and reported as unfit
+    groups = groups.astype(float)
+    groups[:100] = np.NaN
+    models = fit.hurdle_grouped(x, y, groups, max_workers=2)
+    assert set(models) == {1, 3}
+    assert models.report.loc[3, 'n_obs'] == 400
+    assert models.report['error'].iloc[-1] == 'missing group'
+    assert models.report['n_obs'].iloc[-1] == 100
+    assert np.isnan(models.predict(x, groups)[:100]).all()
+
+
+def test_hurdle_folds():
+    import numpy as np
+
+    from carbonplan_forest_risks import fit, utils
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(1000, 3))
+    y = np.where(rng.random(1000) < 0.3, np.exp(0.3 * x[:, 0]), 0)
+    # incomplete rows are dropped before fitting, wherever the fold moves y
+    x[[5, 650]] = np.NaN
+    y[[7, 999]] = np.NaN
+    train = np.arange(1000) < 600
+    full = fit.hurdle(x, y, log=False)
+    held_out = fit.BlockFold(10, train=np.arange(6))
+    shuffle = fit.BlockFold(10, order=np.arange(10)[::-1], seed=1)
+    folds = [(train, None), (None, y[::-1]), held_out, shuffle, (np.flatnonzero(train), None)]
+    models = fit.hurdle_folds(x, y, folds, log=False, init=full)
+
+    expected = fit.hurdle(x[train], y[train], log=False)
+    np.testing.assert_allclose(models[0].predict(x), expected.predict(x), rtol=1e-3)
+    np.testing.assert_allclose(models[4].predict(x), expected.predict(x), rtol=1e-3)
+    assert models[0].n_obs == 598 and models[1].n_obs == 996
+    clean = x[:5]
+    assert utils.remove_nans(clean, y[:5])[0] is clean
+    np.testing.assert_array_equal(held_out.rows(1000), train)
+    np.testing.assert_allclose(models[2].predict(x), expected.predict(x), rtol=1e-3)
+    shuffled = np.random.default_rng(1).permutation(y.reshape(10, -1)[::-1].ravel())
+    np.testing.assert_array_equal(shuffle.target(y), shuffled)
+    expected = fit.hurdle(x, shuffled, log=False)
+    np.testing.assert_allclose(models[3].predict(x), expected.predict(x), rtol=1e-3)
+
+
+def test_growth_gradient():
+    import numpy as np
+    from scipy import stats
+
+    from carbonplan_forest_risks.fit.growth import logistic, negloglik, negloglik_hess
+
+    rng = np.random.default_rng(0)
+    x = rng.uniform(1, 100, 50)
+    f = [rng.normal(size=50), rng.normal(size=50)]
+    y = rng.uniform(1, 200, 50)
+    p = np.array([120, 0.05, 8, 3, -2, 15.0])
+    mu = logistic(x, f, p[:5])
+    for noise, dist in [
+        ('gamma', stats.gamma(mu / p[5], scale=p[5])),
+        ('normal', stats.norm(mu, p[5])),
+    ]:
+        value, grad = negloglik(x, y, f, p, noise=noise)
+        np.testing.assert_allclose(value, -dist.logpdf(y).sum())
+
+        # central differences with a step relative to each parameter
+        loss = lambda q: negloglik(x, y, f, q, noise=noise)[0]
+        steps = np.diag(1e-6 * np.abs(p))
+        numeric = [(loss(p + step) - loss(p - step)) / (2 * step.sum()) for step in steps]
+        np.testing.assert_allclose(grad, numeric, rtol=1e-5)
+
+        # and the Hessian against central differences of the gradient
+        gradient = lambda q: negloglik(x, y, f, q, noise=noise)[1]
+        numeric = [(gradient(p + step) - gradient(p - step)) / (2 * step.sum()) for step in steps]
+        np.testing.assert_allclose(negloglik_hess(x, y, f, p, noise=noise), numeric, rtol=1e-5)
+
+
+def test_growth_grouped():
+    import numpy as np
+    import pandas as pd
+
+    from carbonplan_forest_risks import fit
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            'type_code': np.repeat([1, 2], 200),
+            'age': rng.uniform(1, 150, 400),
+            'tmean_mean': rng.normal(10, 3, 400),
+            'ppt_mean': rng.normal(800, 200, 400),
+        }
+    )
+    mu = 100 * (1 / (1 + 6 * np.exp(-0.04 * df['age'])) - 1 / 7) * 7 / 6
+    df['biomass'] = rng.gamma(mu / 10, 10)
+    models = fit.growth_grouped(df, max_workers=2)
+
+    assert list(models.params.index) == [1, 2] and models.params['success'].all()
+    f = [df['tmean_mean'], df['ppt_mean']]
+    prediction = models.predict(df['age'], f, df['type_code'])
+    expected = models[2].predict(df['age'][200:], [v[200:] for v in f])
+    np.testing.assert_allclose(prediction[200:], expected)
+
+
+def test_growth_project_matches_loop():
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    from carbonplan_forest_risks.fit.growth import GroupedGrowthModel, logistic
+
+    rng = np.random.default_rng(0)
+    params = pd.DataFrame(
+        {
+            'a': [90.0, 120.0],
+            'b': [0.05, 0.03],
+            'c': [5.0, 8.0],
+            'w0': [2.0, -1.0],
+            'w1': [0.5, 1.0],
+        },
+        index=pd.Index([1, 2], name='type_code'),
+    )
+    models = GroupedGrowthModel({}, params)
+    n = 40
+    age = rng.uniform(0, 80, n)
+    year = rng.integers(2000, 2020, n)
+    groups = rng.choice([1, 2, 3], n)
+    targets = np.arange(2005, 2050, 10)
+    dims = ['gcm', 'scenario', 'target', 'plot']
+    f = [xr.DataArray(rng.normal(size=(2, 3, len(targets), n)), dims=dims) for _ in range(2)]
+    projection = models.project(age, year, f, groups, targets)
+
+    # the per-group, per-column recursion the biomass script used before
+    expected = np.full(projection.shape, np.NaN)
+    for code, row in params.iterrows():
+        p = row[['a', 'b', 'c', 'w0', 'w1']].values
+        inds = groups == code
+        for g in range(2):
+            for s in range(3):
+                for it, target in enumerate(targets):
+                    fv = [v.values[g, s, it, inds] for v in f]
+                    x = age[inds] + (float(target) - year[inds])
+                    if it == 0:
+                        value = logistic(np.maximum(x, 0), fv, p)
+                    else:
+                        prev = x - (float(target) - float(targets[it - 1]))
+                        diff = logistic(x, fv, p) - logistic(prev, fv, p)
+                        value = np.maximum(expected[g, s, it - 1, inds] + diff, 0)
+                    expected[g, s, it, inds] = value
+
+    np.testing.assert_allclose(projection.values, expected, rtol=1e-12)
+    assert np.isnan(projection.values[..., groups == 3]).all()
+
+
+def test_run_tasks_zarr_regions(tmp_path):
+    import numpy as np
+    import xarray as xr
+
+    from carbonplan_forest_risks import runner
+
+    store = str(tmp_path / 'out.zarr')
+    coords = {'scenario': ['a', 'b'], 'time': np.arange(6), 'x': np.arange(3)}
+    chunks = {'scenario': 1, 'time': 2, 'x': 3}
+    runner.zarr_template(store, 'p', ['scenario', 'time', 'x'], coords, chunks)
+
+    def task(key):
+        s, t = key
+        if (s, t) == (1, 2):
+            raise ValueError('bad decade')
+        values = np.full((1, 2, 3), 10 * s + t, dtype='float32')
+        region = {'scenario': slice(s, s + 1), 'time': slice(2 * t, 2 * t + 2)}
+        runner.write_region(store, 'p', values, ['scenario', 'time', 'x'], region)
+
+    tasks = [(s, t) for s in range(2) for t in range(3)]
+    report = runner.run_tasks(task, tasks[::-1], max_workers=3, retries=1)
+
+    assert report.loc[(1, 2), 'status'] == 'failed' and report.loc[(1, 2), 'attempts'] == 2
+    assert (report['status'] == 'done').sum() == 5
+    p = xr.open_zarr(store)['p'].values
+    assert p[0, :, 0].tolist() == [0, 0, 1, 1, 2, 2]
+    assert p[1, 2, 0] == 11 and np.isnan(p[1, 4:]).all()
+
+
+def test_run_state_resume(tmp_path, monkeypatch):
+    import carbonplan_forest_risks
+    from carbonplan_forest_risks import runner
+
+    calls = []
+
+    def unit(value):
+        calls.append(value)
+        return {'value': value}
+
+    params = {'store': 'az', 'variables': ['ppt', 'tmean']}
+    state = runner.RunState('biomass', params, root=tmp_path)
+    assert state.compute(('gcm', 'ssp245', 2020), lambda: unit(1)) == {'value': 1}
+
+    resumed = runner.RunState('biomass', params, root=tmp_path)
+    assert resumed.path == state.path and resumed.is_done(('gcm', 'ssp245', 2020))
+    assert resumed.compute(('gcm', 'ssp245', 2020), lambda: unit(2)) == {'value': 1}
+    assert resumed.pending(['fit', ('gcm', 'ssp245', 2020)]) == ['fit']
+
+    fresh = runner.RunState('biomass', {**params, 'store': 'gs'}, root=tmp_path)
+    assert fresh.path != state.path
+    assert fresh.compute(('gcm', 'ssp245', 2020), lambda: unit(3)) == {'value': 3}
+    assert calls == [1, 3]
+
+    # a changed input file also starts a fresh run
+    source = tmp_path / 'source.parquet'
+    source.write_bytes(b'a')
+    before = runner.RunState('biomass', params, inputs=[source], root=tmp_path)
+    source.write_bytes(b'ab')
+    after = runner.RunState('biomass', params, inputs=[source], root=tmp_path)
+    assert len({state.path, before.path, after.path}) == 3
+    assert runner.store_inputs('gs', ['a/b.zarr']) == ['gs://a/b.zarr/.zmetadata']
+
+    # so do changed fitting options or a new package version
+    refit = runner.RunState('biomass', {**params, 'fit': {'noise': 'normal'}}, root=tmp_path)
+    assert refit.path != state.path
+    monkeypatch.setattr(carbonplan_forest_risks, '__version__', '999')
+    assert runner.RunState('biomass', params, root=tmp_path).path != state.path
+
+
+def test_model_save_load(tmp_path):
+    import numpy as np
+
+    from carbonplan_forest_risks import fit
+    from carbonplan_forest_risks.fit.growth import GrowthModel
+    from carbonplan_forest_risks.fit.hurdle import HurdleModel
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(500, 3))
+    y = np.where(x[:, 0] + rng.normal(size=500) > 0, np.exp(0.5 * x[:, 1]), 0)
+    model = fit.hurdle(x, y, log=True)
+    model.save(tmp_path / 'hurdle.npz', feature_names=['a', 'b', 'c'], x_mean=np.zeros(3))
+    loaded = HurdleModel.load(tmp_path / 'hurdle.npz')
+
+    x[0, 1] = np.NaN
+    for kind in ['predict', 'predict_prob', 'predict_linear']:
+        np.testing.assert_allclose(getattr(loaded, kind)(x), getattr(model, kind)(x))
+    assert loaded.feature_names == ['a', 'b', 'c'] and loaded.x_std is None
+    assert loaded.train_roc == model.train_roc
+
+    age = rng.uniform(1, 100, 300)
+    f = [rng.normal(size=300), rng.normal(size=300)]
+    growth = fit.growth(age, rng.gamma(5, 10, 300), f)
+    growth.save(tmp_path / 'growth.npz')
+    loaded = GrowthModel.load(tmp_path / 'growth.npz')
+    np.testing.assert_array_equal(loaded.predict(age, f), growth.predict(age, f))
+    assert loaded.scale == growth.scale and loaded.noise == 'gamma'
+
+
+def test_layer_cache(tmp_path, monkeypatch):
+    import os
+
+    import numpy as np
+    import rasterio
+    import xarray as xr
+    from rasterio.transform import from_origin
+
+    from carbonplan_forest_risks import load
+    from carbonplan_forest_risks.setup.cache import LayerCache
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    tiffs = tmp_path / 'workdir' / 'carbonplan-data' / 'processed' / 'nlcd' / 'conus' / '4000m'
+    tiffs.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+
+    def write_tiff(c):
+        with rasterio.open(
+            tiffs / f'2001_c{c}.tif',
+            'w',
+            driver='GTiff',
+            height=8,
+            width=6,
+            count=1,
+            dtype='float32',
+            transform=from_origin(0, 8, 1, 1),
+        ) as dst:
+            dst.write(rng.random((1, 8, 6), dtype='float32'))
+
+    for c in [41, 42]:
+        write_tiff(c)
+    mask = load.nlcd(store='local', classes=[41], cache=False).sum('band') > 0.3
+
+    cache = LayerCache(directory=tmp_path / 'layers', max_entries=1)
+    kwargs = dict(store='local', classes=[41, 42], coarsen=2, mask=mask.astype('float'))
+    expected = load.nlcd(cache=False, **kwargs)
+    first = load.nlcd(cache=cache, **kwargs)
+    first[:] = 0
+
+    # repeat calls come from memory, then from the zarr store, without reading the tiffs
+    with monkeypatch.context() as m:
+        m.setattr(xr, 'open_rasterio', None)
+        np.testing.assert_array_equal(load.nlcd(cache=cache, **kwargs).values, expected.values)
+        reloaded = load.nlcd(cache=LayerCache(directory=tmp_path / 'layers'), **kwargs)
+    np.testing.assert_array_equal(reloaded.values, expected.values)
+    assert reloaded['band'].values.tolist() == [41, 42]
+
+    # a reprocessed source tiff is picked up by a new process
+    write_tiff(42)
+    os.utime(tiffs / '2001_c42.tif', (1e9, 1e9))
+    rebuilt = load.nlcd(cache=LayerCache(directory=tmp_path / 'layers'), **kwargs)
+    np.testing.assert_array_equal(rebuilt.values, load.nlcd(cache=False, **kwargs).values)
+    assert not np.array_equal(rebuilt.values, expected.values, equal_nan=True)
+
+
+def test_nftd_small_band_merges():
+    import numpy as np
+    import xarray as xr
+
+    from carbonplan_forest_risks.load.nftd import merge_bands, small_band_merges
+
+    rng = np.random.default_rng(0)
+    base = rng.random((2, 6, 5))
+    values = np.concatenate([base, base[::-1] * 0.1 + rng.random((2, 6, 5)) * 0.01])
+    values[:, 0, 0] = np.NaN
+    values[2, 1, :] = np.NaN
+    bands = xr.DataArray(values, dims=['band', 'y', 'x'], coords={'band': [10, 20, 30, 40]})
+
+    merges = small_band_merges(bands, area_threshold=5)
+    assert merges == {30: 20, 40: 10}
+    merged = merge_bands(bands, merges)
+    assert merged['band'].values.tolist() == [10, 20]
+    np.testing.assert_allclose(merged.sel(band=20).values, values[1] + values[2])